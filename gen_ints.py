@@ -1,11 +1,15 @@
 #!/usr/bin/env python3.9
-from itertools import chain, repeat
+from itertools import chain, product, repeat
 from math import ceil
 import random
 import argparse
+import json
+import mmap
+import os
 from multiprocessing import Pool
 from pathlib import Path
 import shutil
+import numpy as np
 import z3
 
 
@@ -37,6 +41,47 @@ def gen_skewed(k):
                      ))
 
 
+# counts of every digit in the skewed population
+SKEW_FACTORS = (10**7, 10**4, 10**2, 10**1)
+SKEW_TIERS = (10, 90, 900, 9000)
+# numbers generated per gen_ints call
+NUM_INTS = {"skewed": int(1e6), "uniform_dig": int(4e6), "uniform_num": int(2.25e6)}
+# numbers per chunk in the streaming writer
+CHUNK_SIZE = 1 << 20
+POW10 = 10 ** np.arange(1, 19, dtype=np.int64)
+
+
+def digit_population(n: int, k: int):
+    """Population of n-digit integers that gen_uniform_digit samples k from"""
+    values = np.arange(pow(10, n - 1), pow(10, n), dtype=np.int64)
+    counts = np.full(len(values), ceil(k / len(values)), dtype=np.int64)
+    return values, counts
+
+
+def range_population(low, high, k):
+    """Population of [low, high) that gen_uniform_num samples k from"""
+    values = np.arange(low, high, dtype=np.int64)
+    counts = np.full(len(values), ceil(k / len(values)), dtype=np.int64)
+    return values, counts
+
+
+def skewed_population():
+    values = np.arange(0, sum(SKEW_TIERS), dtype=np.int64)
+    counts = np.repeat(np.array(SKEW_FACTORS, dtype=np.int64), SKEW_TIERS)
+    return values, counts
+
+
+def np_expand(rng: np.random.Generator, values, picked):
+    """Shuffled array with picked[i] copies of values[i]"""
+    nums = np.repeat(values, picked)
+    rng.shuffle(nums)
+    return nums
+
+
+def make_rng(seed=None) -> np.random.Generator:
+    return np.random.default_rng(seed)
+
+
 def write(ints, name: str, mode="w"):
     with open(name, mode) as f:
         f.writelines(map(lambda n: "%d\n" % n, ints))
@@ -55,6 +100,89 @@ def gen_ints(name):
     return nums
 
 
+def populations(name, k):
+    """(values, counts, sample size) of every population gen_ints samples from"""
+    if name == "skewed":
+        return [(*skewed_population(), k)]
+    elif name == "uniform_dig":
+        sizes = [k // 4 + (i < k % 4) for i in range(4)]
+        return [(*digit_population(i + 1, size), size)
+                for i, size in enumerate(sizes) if size]
+    elif name == "uniform_num":
+        return [(*range_population(0, int(1e4), k), k)]
+    return []
+
+
+def np_draw_ints(name, rng: np.random.Generator, k):
+    """Decide how many copies of every value go into a sample of k numbers,
+    without materializing the sample itself.
+
+    Each population is the vectorized equivalent of random.sample(values, size,
+    counts=counts): a multivariate hypergeometric draw, i.e. without replacement."""
+    pops = populations(name, k)
+    if not pops:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    values = np.concatenate([values for values, _, _ in pops])
+    picked = np.concatenate([rng.multivariate_hypergeometric(counts, size)
+                             for _, counts, size in pops])
+    return values, picked
+
+
+def np_gen_ints(name, rng: np.random.Generator, k=None):
+    """Same as gen_ints, but backed by a numpy Generator.
+
+    k overrides the amount of numbers generated, keeping the distribution."""
+    if k is None:
+        k = NUM_INTS.get(name, 0)
+    return np_expand(rng, *np_draw_ints(name, rng, k))
+
+
+def line_bytes(values):
+    """Size of the "%d\\n" representation of each value"""
+    return np.searchsorted(POW10, values, side="right") + 2
+
+
+def gen_chunks(name, rng: np.random.Generator, total: int, chunk_size=CHUNK_SIZE):
+    """Generate total numbers in chunks of at most chunk_size"""
+    while total > 0:
+        size = min(total, chunk_size)
+        yield np_gen_ints(name, rng, size)
+        total -= size
+
+
+def format_ints(nums) -> np.ndarray:
+    """Render non-negative ints as newline-delimited ascii into a single buffer.
+
+    All the numbers are converted one digit position at a time, so the
+    python-level loop runs at most 19 times regardless of len(nums)."""
+    nums = np.asarray(nums, dtype=np.int64)
+    if not len(nums):
+        return np.empty(0, dtype=np.uint8)
+    assert nums.min() >= 0, "Only non-negative ints are supported"
+    widths = line_bytes(nums) - 1
+    ends = np.cumsum(widths + 1)
+    buf = np.empty(ends[-1], dtype=np.uint8)
+    buf[ends - 1] = ord("\n")
+    # fill digits right to left, dropping numbers once they run out of digits
+    pos = ends - 2
+    rem = nums
+    for dig in range(int(widths.max())):
+        if dig:
+            mask = widths > dig
+            pos, rem, widths = pos[mask], rem[mask], widths[mask]
+        buf[pos] = ord("0") + rem % 10
+        pos = pos - 1
+        rem = rem // 10
+    return buf
+
+
+def write_chunks(chunks, name: str, mode="wb"):
+    """Write each chunk of ints with a single write call"""
+    with open(name, mode) as f:
+        for chunk in chunks:
+            f.write(format_ints(chunk))
+
+
 def fit_bytes(digs, total_bytes):
     """Generate population sizes of digs such that total size of their
     str representation ~= total_bytes.
@@ -76,6 +204,20 @@ def fit_bytes(digs, total_bytes):
     return sizes
 
 
+def fit_bytes_exact(digs, total_bytes):
+    """Same as fit_bytes, but computed directly instead of a random walk.
+
+    Every bucket gets total_bytes // sum(digs) lines, then the remainder is
+    handed out greedily, widest digits first. Exact whenever 1 in digs."""
+    assert 0 <= total_bytes
+    lines, remaining = divmod(total_bytes, sum(digs))
+    sizes = [lines] * len(digs)
+    for i in sorted(range(len(digs)), key=lambda i: digs[i], reverse=True):
+        extra, remaining = divmod(remaining, digs[i])
+        sizes[i] += extra
+    return sizes
+
+
 def approx_eq(a, b, delta):
     diff = a - b
     return z3.And(-delta<diff, diff < delta)
@@ -133,47 +275,132 @@ def gen_expected(n, expected_ratio, k, total_bytes, all_digs=tuple(range(1, 10))
     return nums
 
 
-def gen_expected_model(n: int, ratio: float, total_bytes: int, all_digs=tuple(range(1, 10))):
-    solver = z3.Solver()
-    total_lines = z3.Int('total_lines')
-    target_lines = z3.Int(f'lines{n}')
-    target_bytes = target_lines * z3.IntVal(n)
-    e_target_lines = approx_eq(target_lines, z3.RealVal(ratio) * total_lines, z3.RealVal(100))
-    solver.add(e_target_lines)
+class ExpectedModel:
+    """Line counts per digit such that n-digit lines make up ratio of all lines
+    and the total size ~= total_bytes.
+
+    The structural constraints are asserted once, so sweeping over many
+    (ratio, total_bytes) points only pushes/pops the per-point ones."""
+
+    def __init__(self, n: int, all_digs=tuple(range(1, 10))):
+        self.n = n
+        self.solver = z3.Solver()
+        self.total_lines = z3.Int('total_lines')
+        self.target_lines = z3.Int(f'lines{n}')
+        target_bytes = self.target_lines * z3.IntVal(n)
+
+        other_digs = tuple(sorted(set(all_digs) - {n}))
+        self.other_lines = [z3.Int(f'lines{d}') for d in other_digs]
+        self.lines = dict(zip(other_digs, self.other_lines))
+        self.lines[n] = self.target_lines
+        total_lines_eqn = sum(self.other_lines, self.target_lines)
+        e_total_lines = approx_eq(total_lines_eqn, self.total_lines, 1000)
+        self.solver.add(e_total_lines)
+
+        other_bytes = [d * lines for d, lines in zip(other_digs, self.other_lines)]
+        self.total_bytes_eqn = sum(other_bytes, target_bytes)
+
+        # make others equal
+        other_lines_avg = sum(self.other_lines) / len(self.other_lines)
+        e_other_lines_avg = z3.And(*(approx_eq(lines, other_lines_avg, 1000)
+                                     for lines in self.other_lines))
+        self.solver.add(e_other_lines_avg)
+
+        # sanity checks:
+        e_all_geq0 = z3.And([lines > 0 for lines in self.other_lines])
+        self.solver.add(e_all_geq0)
+
+    def solve(self, ratio: float, total_bytes: int):
+        """Returns {digits: lines}, or None if unsat"""
+        self.solver.push()
+        try:
+            e_target_lines = approx_eq(self.target_lines, z3.RealVal(ratio) * self.total_lines,
+                                       z3.RealVal(100))
+            self.solver.add(e_target_lines)
+            e_total_bytes = approx_eq(self.total_bytes_eqn, total_bytes, 100)
+            self.solver.add(e_total_bytes)
+            if self.solver.check() != z3.sat:
+                return None
+            model = self.solver.model()
+            return {dig: model.eval(lines).as_long() for dig, lines in sorted(self.lines.items())}
+        finally:
+            self.solver.pop()
 
-    other_digs = tuple(sorted(set(all_digs) - {n}))
-    # other_bytes = z3.RealVal(total_bytes) - target_bytes
-    other_lines = [z3.Int(f'lines{d}') for d in other_digs]
-    total_lines_eqn = sum(other_lines, target_lines)
-    e_total_lines = approx_eq(total_lines_eqn, total_lines, 1000)
-    solver.add(e_total_lines)
-
-    other_bytes = [d * lines for d, lines in zip(other_digs, other_lines)]
-    total_bytes_eqn = sum(other_bytes, target_bytes)
-    e_total_bytes = approx_eq(total_bytes_eqn, total_bytes, 100)
-    solver.add(e_total_bytes)
-    print(e_target_lines)
-
-    # make others equal
-    other_lines_avg = sum(other_lines) / len(other_lines)
-    e_other_lines_avg = z3.And(*(approx_eq(lines, other_lines_avg, 1000) for lines in other_lines))
-    solver.add(e_other_lines_avg)
-
-    # sanity checks:
-    e_all_geq0 = z3.And([lines > 0 for lines in other_lines])
-    solver.add(e_all_geq0)
-    print(solver.check())
-    model = (solver.model())
-    print(model)
-    actual_size = model.eval(total_bytes_eqn)
-    print(actual_size)
-    pass
-
-def worker(worker_id, name):
+
+def gen_expected_model(n: int, ratio: float, total_bytes: int, all_digs=tuple(range(1, 10))):
+    return ExpectedModel(n, all_digs).solve(ratio, total_bytes)
+
+
+MODEL_CACHE = Path("~/.cache/gen_ints/models.json").expanduser()
+
+
+def _model_key(n, ratio, total_bytes, all_digs):
+    return json.dumps([n, ratio, total_bytes, sorted(all_digs)])
+
+
+def _solve_points(n, all_digs, points):
+    model = ExpectedModel(n, all_digs)
+    return [model.solve(ratio, total_bytes) for ratio, total_bytes in points]
+
+
+def _load_models(cache_file: Path):
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def sweep_expected_models(n: int, ratios, totals, all_digs=tuple(range(1, 10)),
+                          num_procs=8, cache_file=MODEL_CACHE):
+    """Solve gen_expected_model for every (ratio, total_bytes) pair.
+
+    Solved models are cached on disk, the rest are split across a process
+    pool, with one incremental solver per worker."""
+    cache = _load_models(cache_file)
+    points = list(product(ratios, totals))
+    missing = [p for p in points if _model_key(n, *p, all_digs) not in cache]
+    if missing:
+        num_procs = min(num_procs, len(missing))
+        parts = [missing[i::num_procs] for i in range(num_procs)]
+        with Pool(num_procs) as pool:
+            results = pool.starmap(_solve_points, ((n, all_digs, part) for part in parts))
+        for part, models in zip(parts, results):
+            for point, model in zip(part, models):
+                cache[_model_key(n, *point, all_digs)] = model
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        # merge with what concurrent sweeps saved meanwhile, and don't share their temp file
+        cache = {**_load_models(cache_file), **cache}
+        tmp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_file, cache_file)
+
+    def parse(model):
+        # json turns the int keys into strings
+        return model and {int(dig): lines for dig, lines in model.items()}
+
+    return {p: parse(cache[_model_key(n, *p, all_digs)]) for p in points}
+
+
+def worker(worker_id, name, engine="python", seed=None):
+    """Generate this worker's part of the output and return its path.
+
+    seed is the worker's own SeedSequence, so workers never share a stream."""
+    output = f"/tmp/ints_{name}{worker_id:02}.csv"
+    seed = seed or np.random.SeedSequence()
+    # drop leftovers of earlier runs, since we append below
+    open(output, "w").close()
+    if engine == "numpy":
+        chunks = gen_chunks(name, make_rng(seed), 25 * NUM_INTS[name])
+        write_chunks(chunks, output, "ab")
+        return output
+    random.seed(int(seed.generate_state(1, np.uint64)[0]))
     for _ in range(25):
         nums = gen_ints(name)
-        write(nums, f"/tmp/ints_{name}{worker_id:02}.csv", "a")
+        write(nums, output, "a")
         del nums
+    return output
 
 
 def concat(output, inputs):
@@ -183,20 +410,111 @@ def concat(output, inputs):
                 shutil.copyfileobj(f_in, f)
 
 
+def parse_size(size: str) -> int:
+    """Parse sizes like 4096, 64K, 10G into bytes"""
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    size = size.strip().upper().removesuffix("B")
+    if size and size[-1] in units:
+        nbytes = int(float(size[:-1]) * units[size[-1]])
+    else:
+        nbytes = int(size)
+    if nbytes < 0:
+        raise ValueError(f"Negative size: {size}")
+    return nbytes
+
+
+def expected_line_bytes(name):
+    """Mean size of a line in the output for the given distribution"""
+    pops = populations(name, CHUNK_SIZE)
+    total = sum(size * np.average(line_bytes(values), weights=counts)
+                for values, counts, size in pops)
+    return total / sum(size for *_, size in pops)
+
+
+def chunk_nbytes(name, seed, size):
+    """Exact output size of a chunk, without generating it"""
+    values, picked = np_draw_ints(name, make_rng(seed), size)
+    return int(picked @ line_bytes(values))
+
+
+def fill_worker(output, name, chunks):
+    """Write each (seed, size, offset) chunk directly into its slice of output"""
+    fd = os.open(output, os.O_WRONLY)
+    try:
+        for seed, size, offset in chunks:
+            rng = make_rng(seed)
+            buf = memoryview(format_ints(np_expand(rng, *np_draw_ints(name, rng, size))))
+            while buf:
+                written = os.pwrite(fd, buf, offset)
+                buf, offset = buf[written:], offset + written
+    finally:
+        os.close(fd)
+
+
+def preallocate(output, size: int):
+    with open(output, "wb") as f:
+        f.truncate(size)
+        if size and hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(f.fileno(), 0, size)
+
+
+def gen_sized(name, output, total_bytes: int, num_procs: int, seed_seq=None):
+    """Generate ~total_bytes worth of numbers directly into output.
+
+    The draws of every chunk are seeded separately, so their exact sizes can
+    be computed up front and then replayed by the workers, each of which
+    pwrite()s into its own byte range of the preallocated file."""
+    lines = round(total_bytes / expected_line_bytes(name))
+    sizes = [CHUNK_SIZE] * (lines // CHUNK_SIZE)
+    if lines % CHUNK_SIZE:
+        sizes.append(lines % CHUNK_SIZE)
+    if not sizes:
+        # less than a line's worth of bytes
+        preallocate(output, 0)
+        return 0
+    seeds = (seed_seq or np.random.SeedSequence()).spawn(len(sizes))
+    with Pool(num_procs) as pool:
+        nbytes = pool.starmap(chunk_nbytes, zip(repeat(name), seeds, sizes))
+        offsets = np.cumsum([0] + nbytes).tolist()
+        preallocate(output, offsets[-1])
+        chunks = list(zip(seeds, sizes, offsets))
+        per_worker = ceil(len(chunks) / num_procs)
+        pool.starmap(fill_worker, ((output, name, chunks[i:i + per_worker])
+                                   for i in range(0, len(chunks), per_worker)))
+    return offsets[-1]
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("name", choices=["skewed", "uniform_dig", "uniform_num"])
     parser.add_argument("--num-procs", type=int, default=8)
     parser.add_argument("--output-dir", type=Path, default=Path("inputs/ints/"))
+    parser.add_argument("--engine", choices=["python", "numpy"], help="Defaults to python")
+    parser.add_argument("--total-bytes", type=parse_size,
+                        help="Write ~this many bytes directly into the output (numpy engine)")
+    parser.add_argument("--seed", type=int,
+                        help="Same seed and --num-procs give byte-identical output")
     args = parser.parse_args()
+    if args.total_bytes is not None and args.engine == "python":
+        parser.error("--total-bytes only works with the numpy engine")
+    engine = args.engine or "python"
     name = args.name
     num_procs = args.num_procs
+    seed_seq = np.random.SeedSequence(args.seed)
+    if args.total_bytes is not None:
+        args.output_dir.mkdir(parents=True, exist_ok=True)
+        output = args.output_dir / f"{name}.csv"
+        size = gen_sized(name, output, args.total_bytes, num_procs, seed_seq)
+        print("Wrote", size, "bytes to", output)
+        return
+    seeds = seed_seq.spawn(num_procs)
     with Pool(num_procs) as pool:
-        pool.starmap(worker, enumerate(repeat(name, num_procs)))
+        parts = pool.starmap(worker, ((i, name, engine, seed)
+                                      for i, seed in enumerate(seeds)))
         pool.close()
     output_dir = args.output_dir
     output_dir.mkdir(parents=True, exist_ok=True)
-    concat(output_dir / f"{name}.csv", Path("/tmp").glob(f"ints_{name}*"))
+    concat(output_dir / f"{name}.csv", parts)
 
 
 from collections import defaultdict
@@ -210,7 +528,75 @@ def read_nums(file: Path):
     print(lens)
 
 
+READ_BLOCK_SIZE = 64 << 20
+
+
+def line_length_hist(file: Path, start=0, end=None, block_size=READ_BLOCK_SIZE):
+    """Histogram of line lengths (incl. newline) in file[start:end].
+
+    start must be at the beginning of a line."""
+    with open(file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if end is None:
+            end = len(mm)
+        hist = np.zeros(0, dtype=np.int64)
+        line_start = start
+        for offset in range(start, end, block_size):
+            count = min(block_size, end - offset)
+            block = np.frombuffer(mm, dtype=np.uint8, count=count, offset=offset)
+            line_ends = np.flatnonzero(block == ord("\n")) + (offset + 1)
+            del block  # release the buffer export before mm closes
+            if not len(line_ends):
+                continue
+            lengths = np.diff(line_ends, prepend=line_start)
+            line_start = line_ends[-1]
+            block_hist = np.bincount(lengths)
+            if len(block_hist) > len(hist):
+                hist.resize(len(block_hist))
+            hist[:len(block_hist)] += block_hist
+    lens = {length: int(num) for length, num in enumerate(hist) if num}
+    if line_start < end:
+        # last line without a trailing newline
+        lens[end - line_start] = lens.get(end - line_start, 0) + 1
+    return lens
+
+
+def split_lines(file: Path, parts: int):
+    """Split file into ~equal byte ranges which start at line boundaries"""
+    size = file.stat().st_size
+    bounds = [0]
+    with open(file, "rb") as f:
+        for i in range(1, parts):
+            pos = max(size * i // parts, bounds[-1])
+            f.seek(pos)
+            pos += len(f.readline())
+            bounds.append(min(pos, size))
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def read_nums_fast(file: Path, num_procs=1):
+    """Same output as read_nums, from a memory map, optionally in parallel"""
+    if not file.stat().st_size:
+        lens = {}
+    elif num_procs > 1:
+        ranges = split_lines(file, num_procs)
+        with Pool(num_procs) as pool:
+            hists = pool.starmap(line_length_hist, ((file, *r) for r in ranges))
+        lens = defaultdict(int)
+        for hist in hists:
+            for length, num in hist.items():
+                lens[length] += num
+    else:
+        lens = line_length_hist(file)
+    lens = dict(sorted(lens.items()))
+    print(lens)
+    return lens
+
+
 if __name__ == '__main__':
+    main()
     # read_nums(Path("inputs/ints/skewed_small.csv"))
-    n = gen_expected_model(2, 0.3, 2000000, tuple(range(1,6)))
-    print(n)
\ No newline at end of file
+    # read_nums_fast(Path("inputs/ints/skewed_small.csv"), num_procs=8)
+    # n = gen_expected_model(2, 0.3, 2000000, tuple(range(1,6)))
+    # print(n)
+    # print(sweep_expected_models(2, (0.1, 0.3, 0.5), (10**6, 10**8), tuple(range(1, 6))))
\ No newline at end of file
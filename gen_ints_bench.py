@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""Throughput benchmarks for the gen_ints pipeline.
+
+Every case runs in a fresh process, so that its peak RSS is its own."""
+import argparse
+import contextlib
+import io
+import json
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing import Pipe, Process
+from pathlib import Path
+
+import numpy as np
+
+import gen_ints
+
+NAMES = ("skewed", "uniform_dig", "uniform_num")
+FIT_TOTALS = [10**exp for exp in range(3, 12)]  # 1KB to 100GB, independent of --sizes
+
+
+def py_gen(name, k):
+    """The python engine's distributions, for k numbers"""
+    if name == "skewed":
+        return gen_ints.gen_skewed(k)
+    elif name == "uniform_dig":
+        nums = []
+        for i in range(1, 5):
+            nums.extend(gen_ints.gen_uniform_digit(i, k // 4))
+        random.shuffle(nums)
+        return nums
+    elif name == "uniform_num":
+        return gen_ints.gen_uniform_num(0, int(1e4), k)
+
+
+def write_input(path: Path, size, name="uniform_num", parts=1):
+    """Write size numbers split into `parts` files, return their paths"""
+    rng = gen_ints.make_rng(0)
+    paths = [path.with_name(f"{path.stem}{i:02}{path.suffix}") for i in range(parts)]
+    for i, part in enumerate(paths):
+        part_size = size // parts + (i < size % parts)
+        gen_ints.write_chunks(gen_ints.gen_chunks(name, rng, part_size), part)
+    return paths
+
+
+def bench_gen(tmp: Path, engine, name, size):
+    if engine == "numpy":
+        rng = gen_ints.make_rng(0)
+        start = time.perf_counter()
+        gen_ints.np_gen_ints(name, rng, size)
+    else:
+        random.seed(0)
+        start = time.perf_counter()
+        py_gen(name, size)
+    return time.perf_counter() - start, 0
+
+
+def bench_write(tmp: Path, writer, size):
+    output = tmp / "write.csv"
+    rng = gen_ints.make_rng(0)
+    if writer == "write":
+        nums = gen_ints.np_gen_ints("uniform_num", rng, size).tolist()
+        start = time.perf_counter()
+        gen_ints.write(nums, output)
+    else:
+        # generated while writing, so peak RSS shows the bounded memory of streaming
+        start = time.perf_counter()
+        gen_ints.write_chunks(gen_ints.gen_chunks("uniform_num", rng, size), output)
+    return time.perf_counter() - start, output.stat().st_size
+
+
+def bench_concat(tmp: Path, procs, size):
+    parts = write_input(tmp / "part.csv", size, parts=procs)
+    output = tmp / "concat.csv"
+    start = time.perf_counter()
+    gen_ints.concat(output, parts)
+    return time.perf_counter() - start, output.stat().st_size
+
+
+def bench_read(tmp: Path, reader, procs, size):
+    file, = write_input(tmp / "read.csv", size)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if reader == "read_nums":
+            gen_ints.read_nums(file)
+        else:
+            gen_ints.read_nums_fast(file, num_procs=procs)
+    return time.perf_counter() - start, file.stat().st_size
+
+
+def bench_sized(tmp: Path, name, procs, size):
+    total_bytes = int(size * gen_ints.expected_line_bytes(name))
+    start = time.perf_counter()
+    nbytes = gen_ints.gen_sized(name, tmp / "sized.csv", total_bytes, procs,
+                                np.random.SeedSequence(0))
+    return time.perf_counter() - start, nbytes
+
+
+def bench_fit_bytes(tmp: Path, func_name, size, digs=tuple(range(1, 10)), repeats=5):
+    """size is the amount of bytes to fit (not numbers), also reports how far off the fit is"""
+    func = getattr(gen_ints, func_name)
+    random.seed(0)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        sizes = func(digs, size)
+    secs = (time.perf_counter() - start) / repeats
+    actual = sum(num * dig for num, dig in zip(sizes, digs))
+    return secs, 0, {"nums_per_sec": None, "off_by": actual - size}
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on linux, bytes on mac
+    scale = 1 << 20 if sys.platform == "darwin" else 1 << 10
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return rss / scale
+
+
+def _run_case(conn, func, args):
+    base_rss = peak_rss_mb()
+    with tempfile.TemporaryDirectory(prefix="gen_ints_bench") as tmp:
+        # cases can return a dict of extra fields for their result
+        secs, nbytes, *extra = func(Path(tmp), *args)
+    extra = {"base_rss_mb": base_rss, **(extra[0] if extra else {})}
+    conn.send((secs, nbytes, peak_rss_mb(), extra))
+    conn.close()
+
+
+def run_case(func, *args):
+    """Results of the case, or None if it raised or got killed"""
+    recv, send = Pipe(duplex=False)
+    proc = Process(target=_run_case, args=(send, func, args))
+    proc.start()
+    # the child holds the only write end now, so its death ends recv() with EOFError
+    send.close()
+    try:
+        result = recv.recv()
+    except EOFError:
+        result = None
+    proc.join()
+    return result if proc.exitcode == 0 else None
+
+
+def get_cases(sizes, procs_list):
+    for size in sizes:
+        for name in NAMES:
+            for engine in ("python", "numpy"):
+                yield f"gen/{engine}/{name}", bench_gen, (engine, name), size, 1
+        for writer in ("write", "write_chunks"):
+            yield f"write/{writer}", bench_write, (writer,), size, 1
+        yield "read/read_nums", bench_read, ("read_nums", 1), size, 1
+        for procs in procs_list:
+            yield "concat", bench_concat, (procs,), size, procs
+            yield "read/read_nums_fast", bench_read, ("read_nums_fast", procs), size, procs
+            for name in NAMES:
+                yield f"sized/{name}", bench_sized, (name, procs), size, procs
+    for total in FIT_TOTALS:
+        for func_name in ("fit_bytes", "fit_bytes_exact"):
+            yield f"fit_bytes/{func_name}", bench_fit_bytes, (func_name,), total, 1
+
+
+def git_rev():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, cwd=Path(__file__).parent).stdout.strip()
+    except OSError:
+        return None
+
+
+def compare(results, baseline_file: Path):
+    with open(baseline_file) as f:
+        baseline = {(r["case"], r["size"], r["procs"]): r for r in json.load(f)["results"]}
+    print(f"\nCompared to {baseline_file} (new time / old time):")
+    for r in results:
+        old = baseline.get((r["case"], r["size"], r["procs"]))
+        if old and not r.get("failed") and not old.get("failed"):
+            print(f"{r['case']:<28} size={r['size']:<10} procs={r['procs']:<3} "
+                  f"{r['seconds'] / old['seconds']:.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=lambda s: [int(float(x)) for x in s.split(",")],
+                        default=[10**5, 10**6], help="Comma separated amounts of numbers")
+    parser.add_argument("--procs", type=lambda s: [int(x) for x in s.split(",")],
+                        default=[1, 2, 4], help="Comma separated process counts")
+    parser.add_argument("--filter", default="", help="Only run cases containing this")
+    parser.add_argument("--output", type=Path, default=Path("gen_ints_bench.json"))
+    parser.add_argument("--compare", type=Path, help="Earlier results to compare against")
+    args = parser.parse_args()
+
+    results = []
+    for case, func, case_args, size, procs in get_cases(args.sizes, args.procs):
+        if args.filter not in case:
+            continue
+        if (case_result := run_case(func, *case_args, size)) is None:
+            results.append({"case": case, "size": size, "procs": procs, "failed": True})
+            print(f"{case:<28} size={size:<10} procs={procs:<3} FAILED")
+            continue
+        secs, nbytes, rss, extra = case_result
+        result = {
+            "case": case, "size": size, "procs": procs, "seconds": secs,
+            "nums_per_sec": size / secs, "mb_per_sec": nbytes / secs / 1e6 if nbytes else None,
+            "peak_rss_mb": rss, **extra,
+        }
+        results.append(result)
+        nums_per_sec = result["nums_per_sec"]
+        nums_per_sec = f"{nums_per_sec:12.0f} nums/s" if nums_per_sec is not None else " " * 19
+        mb_per_sec = f"{result['mb_per_sec']:8.1f} MB/s" if nbytes else " " * 13
+        print(f"{case:<28} size={size:<10} procs={procs:<3} {secs:8.3f}s "
+              f"{nums_per_sec} {mb_per_sec} {rss:8.1f} MB RSS (+{rss - extra['base_rss_mb']:.1f})"
+              + "".join(f" {key}={value}" for key, value in extra.items()
+                        if key not in ("base_rss_mb", "nums_per_sec")))
+
+    meta = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_rev": git_rev(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+    }
+    with open(args.output, "w") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=2)
+    print("Results written to", args.output)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,77 +1,153 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path, PureWindowsPath, PurePosixPath
-from configparser import ConfigParser, NoOptionError
+from configparser import ConfigParser
+from typing import NamedTuple
 
 DRIVE_ROOT = Path("/path/to/drive/")
 
 
+INI_ENTRY_PAT = re.compile(r"(?P<key>[^=:]+?)\s*[=:]\s*(?P<value>.*)")
+
+
+def read_key(file: Path, section: str, key: str):
+    """Read a single key of an ini file, without building a ConfigParser.
+
+    Returns None if the file, section or key doesn't exist."""
+    current = None
+    try:
+        with open(file) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line[0] in '#;':
+                    continue
+                if line[0] == '[' and line[-1] == ']':
+                    if current == section:
+                        break
+                    current = line[1:-1]
+                elif current == section:
+                    m = INI_ENTRY_PAT.match(line)
+                    if m and m['key'] == key:
+                        return m['value']
+    except FileNotFoundError:
+        pass
+    return None
+
+
 class KDEConfig:
-    """Wraps .directory file, handling icon files."""
+    """Wraps .directory file, handling icon files.
 
-    def __init__(self, file: Path):
+    The file is only parsed in full when it is modified. Use as a context
+    manager to coalesce all modifications into a single save on exit."""
+
+    def __init__(self, file: Path, autosave=True):
         assert file.name == '.directory'
-        self.config = ConfigParser(default_section="Desktop Entry")
-        self.config.optionxform = lambda option: option
         self.file = file
-        if self.file.exists():
-            self.config.read(self.file)
+        self.autosave = autosave
+        self.dirty = False
+        self._config = None
+
+    @property
+    def config(self) -> ConfigParser:
+        if self._config is None:
+            self._config = ConfigParser(default_section="Desktop Entry")
+            self._config.optionxform = lambda option: option
+            if self.file.exists():
+                self._config.read(self.file)
+        return self._config
 
     @property
     def icon_path(self) -> PurePosixPath:
-        try:
-            icon_path = self.config.get('Desktop Entry', 'Icon')
-        except NoOptionError:
-            return None
+        if self._config is None:
+            icon_path = read_key(self.file, 'Desktop Entry', 'Icon')
         else:
-            return PurePosixPath(icon_path) if icon_path else None
+            icon_path = self.config.get('Desktop Entry', 'Icon', fallback=None)
+        return PurePosixPath(icon_path) if icon_path else None
 
     @icon_path.setter
     def icon_path(self, icon_path):
         icon_path = str(icon_path)
+        if self.file.exists() and self.config.get('Desktop Entry', 'Icon', fallback=None) == icon_path:
+            return
         self.config.set('Desktop Entry', 'Icon', icon_path)
-        self.save()
+        self.dirty = True
+        if self.autosave:
+            self.save()
 
     def save(self):
         with open(self.file, 'w') as f:
             self.config.write(f, space_around_delimiters=False)
+        self.dirty = False
+
+    def __enter__(self):
+        self.autosave = False
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None and self.dirty:
+            self.save()
 
 
 class WindowsConfig():
-    """Wraps desktop.ini, handling icon files"""
+    """Wraps desktop.ini, handling icon files
+
+    Like KDEConfig, the file is only parsed in full when it is modified."""
 
     def __init__(self, file: Path):
         assert file.name == 'desktop.ini'
-        self.config = ConfigParser(allow_no_value=True, dict_type=dict,
-                                   default_section='.ShellClassInfo')
-        self.config.optionxform = lambda option: option
         self.file = file
-        if self.file.exists():
-            self.config.read(self.file)
-        else:
-            self._populate_default()
+        self._config = None
         self.is_relative = False
-        self.trailing = ''
+        self.trailing = None  # ",N" icon index of IconResource, None until read
+
+    @property
+    def config(self) -> ConfigParser:
+        if self._config is None:
+            self._config = ConfigParser(allow_no_value=True, dict_type=dict,
+                                        default_section='.ShellClassInfo')
+            self._config.optionxform = lambda option: option
+            if self.file.exists():
+                self._config.read(self.file)
+            else:
+                self._populate_default()
+        return self._config
 
     def _populate_default(self):
-        self.config.add_section("ViewState")
-        self.config["ViewState"]["FolderType"] = "Generic"
+        self._config.add_section("ViewState")
+        self._config["ViewState"]["FolderType"] = "Generic"
 
     @property
     def icon_path(self) -> PureWindowsPath:
-        try:
-            icon_res = self.config.get('.ShellClassInfo', 'IconResource')
-        except NoOptionError:
-            return None
+        if self._config is None:
+            icon_res = read_key(self.file, '.ShellClassInfo', 'IconResource')
+        else:
+            icon_res = self.config.get('.ShellClassInfo', 'IconResource', fallback=None)
         if not icon_res:
             return None
         self.is_relative = icon_res.startswith('\\')
+        path, self.trailing = self._split_icon_res(icon_res)
+        return PureWindowsPath(path[int(self.is_relative):])
+
+    @staticmethod
+    def _split_icon_res(icon_res: str):
+        """IconResource as (path, ",N" icon index or '')"""
         end = icon_res.find(',')
-        self.trailing = icon_res[end:]
-        return PureWindowsPath(icon_res[int(self.is_relative):end])
+        if end == -1:
+            end = len(icon_res)
+        return icon_res[:end], icon_res[end:]
 
     @icon_path.setter
     def icon_path(self, icon_path: PureWindowsPath):
-        icon_path = str(icon_path)
-        icon_res = icon_path + self.trailing
+        if self.trailing is None:
+            # keep the icon index of the IconResource being replaced
+            _, self.trailing = self._split_icon_res(
+                self.config.get('.ShellClassInfo', 'IconResource', fallback=''))
+        icon_res = str(icon_path) + self.trailing
         self.config.set('.ShellClassInfo', 'IconResource', icon_res)
 
     def save(self):
@@ -83,14 +159,15 @@ def ico_to_directory(ico: Path, overwrite=True):
     directory_file = ico.with_name('.directory')
     if not overwrite and directory_file.exists():
         return
-    kde_config = KDEConfig(directory_file)
-    kde_config.icon_path = "./" + ico.name
-    kde_config.save()
+    with KDEConfig(directory_file) as kde_config:
+        kde_config.icon_path = "./" + ico.name
 
 
 def ini_to_directory(ini_file: Path, move_to_parent=True):
     win_config = WindowsConfig(ini_file)
     win_icon_path = win_config.icon_path
+    if win_icon_path is None:
+        return
     posix_icon_path = DRIVE_ROOT / win_icon_path.as_posix()
     if not posix_icon_path.exists():
         print(f"Icon file at {posix_icon_path} in desktop.ini doesn't exist.")
@@ -104,14 +181,155 @@ def ini_to_directory(ini_file: Path, move_to_parent=True):
     ico_to_directory(posix_icon_path)
 
 
+class FolderPlan(NamedTuple):
+    """What ini_to_directory would do for one folder"""
+    folder: Path
+    icon: Path  # icon file in the desktop.ini
+    dest: Path  # where the icon ends up, same as icon if it isn't moved
+
+
+class MigrationPlan:
+    """All the icon moves and .directory writes of an ini_to_directory run."""
+
+    def __init__(self):
+        self.folders: list[FolderPlan] = []
+        self.missing: list[tuple[Path, Path]] = []  # (ini file, icon)
+        self.conflicts: list[tuple[Path, str]] = []  # (ini file, reason)
+
+    @property
+    def moves(self):
+        return [plan for plan in self.folders if plan.icon != plan.dest]
+
+    def print_summary(self):
+        for ini_file, icon in self.missing:
+            print(f"Icon file at {icon} in {ini_file} doesn't exist.")
+        for ini_file, reason in self.conflicts:
+            print(f"Skipping {ini_file}: {reason}")
+        print(f"{len(self.folders)} .directory files to write, {len(self.moves)} icons to move, "
+              f"{len(self.missing)} missing icons, {len(self.conflicts)} conflicts")
+
+
+def _list_dirs(dirs, num_threads=16):
+    """{dir: set of names in it, or None if it doesn't exist}"""
+    def list_dir(d):
+        try:
+            return set(os.listdir(d))
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    dirs = list(dirs)
+    with ThreadPoolExecutor(num_threads) as pool:
+        return dict(zip(dirs, pool.map(list_dir, dirs)))
+
+
+def shared_icons(icons):
+    """{ini file: reason} for icons that several folders would move into themselves.
+
+    icons is {ini file: icon file}."""
+    claims = defaultdict(list)
+    for ini_file, icon in icons.items():
+        claims[icon].append(ini_file)
+    return {ini_file: f"{icon} is used by {len(ini_files)} folders"
+            for icon, ini_files in claims.items()
+            if len(ini_files) > 1 and any(f.parent != icon.parent for f in ini_files)
+            for ini_file in ini_files}
+
+
+def plan_ini_to_directory(ini_files, move_to_parent=True):
+    """Plan ini_to_directory for all ini_files, without touching anything.
+
+    Icon existence is checked with one listing per directory instead of a
+    stat per icon. Icons claimed by several folders, and moves that would
+    overwrite a different file, are reported as conflicts."""
+    plan = MigrationPlan()
+    icons = {}
+    for ini_file in ini_files:
+        try:
+            win_icon_path = WindowsConfig(ini_file).icon_path
+        except (OSError, UnicodeDecodeError) as e:
+            plan.conflicts.append((ini_file, f"can't read it: {e}"))
+            continue
+        if win_icon_path is None:
+            plan.conflicts.append((ini_file, "no IconResource"))
+            continue
+        icons[ini_file] = DRIVE_ROOT / win_icon_path.as_posix()
+
+    dirs = {icon.parent for icon in icons.values()}
+    if move_to_parent:
+        dirs.update(ini_file.parent for ini_file in icons)
+    listing = _list_dirs(dirs)
+
+    def exists(path: Path):
+        return path.name in (listing.get(path.parent) or ())
+
+    existing = {}
+    for ini_file, icon in icons.items():
+        if not exists(icon):
+            plan.missing.append((ini_file, icon))
+        else:
+            existing[ini_file] = icon
+
+    shared = shared_icons(existing) if move_to_parent else {}
+    plan.conflicts.extend(shared.items())
+    dests = {}
+    for ini_file, icon in existing.items():
+        if ini_file in shared:
+            continue
+        fold = ini_file.parent
+        dest = fold / icon.name if move_to_parent else icon
+        if dest != icon and exists(dest):
+            plan.conflicts.append((ini_file, f"{dest} already exists"))
+        elif dest in dests:
+            plan.conflicts.append((ini_file, f"{dest} is also the target for {dests[dest]}"))
+        else:
+            dests[dest] = ini_file
+            plan.folders.append(FolderPlan(fold, icon, dest))
+    plan.folders.sort()
+    plan.missing.sort()
+    plan.conflicts.sort()
+    return plan
+
+
+def execute_plan(plan: MigrationPlan):
+    """Carry out the plan one folder at a time: move its icon, then write its .directory."""
+    done = 0
+    for folder_plan in plan.folders:
+        try:
+            if folder_plan.icon != folder_plan.dest:
+                folder_plan.icon.rename(folder_plan.dest)
+            ico_to_directory(folder_plan.dest)
+        except OSError as e:
+            print("Failed to convert", folder_plan.folder, e)
+        else:
+            done += 1
+    print(f"Converted {done} of {len(plan.folders)} folders")
+
+
+def migrate_ini_to_directory(root: Path, dry_run=True, move_to_parent=True):
+    """ini_to_directory for every desktop.ini under root, in two phases.
+
+    With dry_run, only prints what would be done."""
+    plan = plan_ini_to_directory(walk_files(root, {"desktop.ini"}), move_to_parent)
+    if dry_run:
+        for folder_plan in plan.folders:
+            if folder_plan.icon != folder_plan.dest:
+                print("Move", folder_plan.icon, "->", folder_plan.dest)
+            print("Write", folder_plan.folder / ".directory")
+    plan.print_summary()
+    if not dry_run:
+        execute_plan(plan)
+    return plan
+
+
 def directory_to_ini(directory_file: Path, update=False):
     ini_file = directory_file.parent / "desktop.ini"
     if not update and ini_file.exists():
         return
+    icon_path = KDEConfig(directory_file).icon_path
+    if icon_path is None:
+        return
     print("Converting", directory_file.parent.name)
-    kde_config = KDEConfig(directory_file)
-    if not kde_config.icon_path.is_absolute():
-        posix_icon_path = directory_file.parent / kde_config.icon_path
+    posix_icon_path = icon_path if icon_path.is_absolute() else directory_file.parent / icon_path
     win_config = WindowsConfig(ini_file)
     rel_path = posix_icon_path.relative_to(DRIVE_ROOT)
     win_icon_path = PureWindowsPath("\\" + "\\".join(rel_path.parts))
@@ -132,9 +350,195 @@ def temp():
         print(rel_path)
 
 
+def _scan_dir(directory: str, names):
+    """Returns the files in directory with one of names, and its subdirectories"""
+    found, subdirs = [], []
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.name in names:
+                    found.append(Path(entry.path))
+    except OSError as e:
+        print("Could not scan", directory, e)
+    return found, subdirs
+
+
+def walk_files(root: Path, names, num_threads=16, report_every=5.0):
+    """Yield all files under root named one of names, like rglob.
+
+    Directories are scanned concurrently, which matters on network drives
+    where every listing is a round trip."""
+    names = frozenset(names)
+    start = last_report = time.monotonic()
+    num_dirs = num_found = 0
+    with ThreadPoolExecutor(num_threads) as pool:
+        pending = {pool.submit(_scan_dir, str(root), names)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                found, subdirs = future.result()
+                num_dirs += 1
+                num_found += len(found)
+                pending.update(pool.submit(_scan_dir, d, names) for d in subdirs)
+                yield from found
+            if report_every and time.monotonic() - last_report > report_every:
+                last_report = time.monotonic()
+                rate = num_dirs / (last_report - start)
+                print(f"Scanned {num_dirs} folders ({rate:.0f}/s), found {num_found} files")
+
+
+def convert_tree(root: Path, converters, num_threads=16):
+    """Run converters[file.name](file) on every matching file under root.
+
+    Files are handed to the converter threads as soon as the walker finds them."""
+    start = time.monotonic()
+    num_converted = 0
+    with ThreadPoolExecutor(num_threads) as pool:
+        futures = {pool.submit(converters[file.name], file): file
+                   for file in walk_files(root, converters, num_threads)}
+        for future, file in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                print("Failed to convert", file, e)
+            else:
+                num_converted += 1
+    elapsed = time.monotonic() - start
+    print(f"Processed {num_converted} of {len(futures)} files in {elapsed:.1f}s "
+          f"({len(futures) / max(elapsed, 1e-9):.0f} files/s)")
+
+
 def populate_missing_ini(directory: Path):
-    for directory_file in directory.rglob(".directory"):
-        directory_to_ini(directory_file)
+    convert_tree(directory, {".directory": directory_to_ini})
+
+
+def _file_state(path: Path):
+    try:
+        stat = path.stat()
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def folder_state(folder: Path, icon: Path = None):
+    """mtime and size of the icon related files in folder"""
+    return {
+        ".directory": _file_state(folder / ".directory"),
+        "desktop.ini": _file_state(folder / "desktop.ini"),
+        "icon": str(icon) if icon else None,
+        "icon_state": _file_state(icon) if icon else None,
+    }
+
+
+class SyncIndex:
+    """Remembers the folder_state of each folder as of its last conversion."""
+
+    def __init__(self, file: Path):
+        self.file = file
+        self.lock = threading.Lock()
+        try:
+            with open(file) as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.entries = {}
+
+    def get(self, folder: Path):
+        return self.entries.get(str(folder))
+
+    def set(self, folder: Path, state):
+        with self.lock:
+            self.entries[str(folder)] = state
+
+    def prune(self, root: Path, seen):
+        """Forget folders under root that no longer have any config"""
+        seen = {str(folder) for folder in seen}
+        prefix = str(root).rstrip(os.sep) + os.sep
+        with self.lock:
+            for folder in [f for f in self.entries if f.startswith(prefix) and f not in seen]:
+                del self.entries[folder]
+
+    def save(self):
+        tmp_file = self.file.with_name(self.file.name + ".tmp")
+        with self.lock, open(tmp_file, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_file, self.file)
+
+
+def _win_icon(ini_file: Path):
+    """(icon of ini_file or None, error if it can't be read)"""
+    try:
+        return WindowsConfig(ini_file).icon_path, None
+    except (OSError, UnicodeDecodeError) as e:
+        return None, e
+
+
+def needs_sync(folder: Path, index: SyncIndex):
+    old = index.get(folder)
+    return not old or folder_state(folder, old["icon"] and Path(old["icon"])) != old
+
+
+def sync_folder(folder: Path, index: SyncIndex, shared=None):
+    """Convert whichever of .directory / desktop.ini changed into the other.
+
+    Folders without an icon are only recorded in the index. A desktop.ini whose
+    icon is in shared (see shared_icons) is skipped, as moving it would race.
+    Returns False if nothing changed since the last sync."""
+    if not needs_sync(folder, index):
+        return False
+    kde_state = _file_state(folder / ".directory")
+    win_state = _file_state(folder / "desktop.ini")
+    if kde_state and (not win_state or kde_state[0] >= win_state[0]):
+        directory_to_ini(folder / ".directory", update=True)
+    elif win_state:
+        ini_file = folder / "desktop.ini"
+        if shared and ini_file in shared:
+            print(f"Skipping {ini_file}: {shared[ini_file]}")
+            return False
+        ini_to_directory(ini_file)
+    icon = None
+    if (folder / ".directory").exists():
+        icon_path = KDEConfig(folder / ".directory").icon_path
+        if icon_path:
+            icon = folder / icon_path
+    index.set(folder, folder_state(folder, icon))
+    return True
+
+
+INDEX_NAME = ".icon_sync.json"
+
+
+def sync_tree(root: Path, index_file: Path = None, num_threads=16):
+    """Sync KDE and Windows folder icons both ways, skipping unchanged folders."""
+    index = SyncIndex(index_file or root / INDEX_NAME)
+    start = time.monotonic()
+    folders = {file.parent for file in walk_files(root, {".directory", "desktop.ini"}, num_threads)}
+    with ThreadPoolExecutor(num_threads) as pool:
+        changed = [folder for folder, is_changed in
+                   zip(folders, pool.map(lambda folder: needs_sync(folder, index), folders)) if is_changed]
+        # icons claimed by several changed folders can't be moved into all of them
+        ini_files = [folder / "desktop.ini" for folder in changed]
+        win_icons, unreadable = {}, set()
+        for ini_file, (icon, error) in zip(ini_files, pool.map(_win_icon, ini_files)):
+            if error:
+                print(f"Skipping {ini_file}: can't read it: {error}")
+                unreadable.add(ini_file.parent)
+            elif icon:
+                win_icons[ini_file] = DRIVE_ROOT / icon.as_posix()
+        changed = [folder for folder in changed if folder not in unreadable]
+        shared = shared_icons(win_icons)
+        futures = {pool.submit(sync_folder, folder, index, shared): folder for folder in changed}
+        num_synced = 0
+        for future, folder in futures.items():
+            try:
+                num_synced += future.result()
+            except Exception as e:
+                print("Failed to sync", folder, e)
+    index.prune(root, folders)
+    index.save()
+    print(f"Synced {num_synced} of {len(folders)} folders "
+          f"in {time.monotonic() - start:.1f}s")
 
 
 if __name__ == '__main__':
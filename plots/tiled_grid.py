@@ -7,10 +7,38 @@
 # ///
 
 
-import matplotlib.pyplot as plt
-import matplotlib.colors as mcolors
+import argparse
+from multiprocessing import Pool
+from pathlib import Path
+import struct
+import zlib
+
 import numpy as np
 
+# matplotlib is slow to import, so it is only pulled in once something is rendered
+
+
+def get_pyplot():
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def to_rgba(color):
+    """
+    Convert a color to an (r, g, b, a) tuple of floats.
+
+    Hex strings and tuples are parsed directly, only named colors need matplotlib.
+    """
+    if isinstance(color, str) and color.startswith('#') and len(color) in (7, 9):
+        rgba = tuple(int(color[i:i + 2], 16) / 255 for i in range(1, len(color), 2))
+    elif not isinstance(color, str) and len(color) in (3, 4):
+        rgba = tuple(float(c) for c in color)
+    else:
+        import matplotlib.colors as mcolors
+        return mcolors.to_rgba(color)
+    return rgba + (1.0,) * (4 - len(rgba))
+
+
 def create_color_palette(base_color, num_colors=16, min_intensity=0.4, max_intensity=1.0):
     """
     Create a custom color palette with varying intensities of the base color.
@@ -32,20 +60,15 @@ def create_color_palette(base_color, num_colors=16, min_intensity=0.4, max_inten
     """
     # Convert string color to rgb
     if isinstance(base_color, str):
-        base_rgb = mcolors.to_rgb(base_color)
+        base_rgb = to_rgba(base_color)[:3]
     else:
         base_rgb = base_color
     
-    # Create a list of colors with varying intensity
-    colors = []
-    for i in range(num_colors):
-        # Scale intensity from min to max
-        intensity = min_intensity + (max_intensity - min_intensity) * (i / (num_colors - 1))
-        # Create color with adjusted intensity
-        color = tuple(min(1.0, c * intensity) for c in base_rgb) + (1.0,)  # Add alpha=1.0
-        colors.append(color)
-    colors.reverse()
-    return colors
+    # Scale intensity from min to max, one row per color
+    intensity = np.linspace(min_intensity, max_intensity, num_colors)[:, np.newaxis]
+    colors = np.ones((num_colors, 4))  # alpha=1.0
+    colors[:, :3] = np.minimum(1.0, np.asarray(base_rgb) * intensity)
+    return [tuple(color) for color in colors[::-1]]
 
 colors = [
     ["#57bb8a", "#61bf91", "#6ac397", "#73c79e", "#e67c73", "#e8847b", "#e98b83", "#eb938b"],
@@ -59,15 +82,55 @@ colors = [
 ]
 
 def hex_to_rgba(hex_color):
-    res =  tuple(c for c in mcolors.to_rgba(hex_color))
+    res =  to_rgba(hex_color)
     assert len(res) == 4, hex_color
     return res
 
+def palette_to_array(palette):
+    """
+    Convert a palette (list of colors, hex strings or rgba tuples) to an
+    array of shape (num_colors, 4) in one go.
+    """
+    return np.array([to_rgba(color) for color in palette], dtype=float)
+
+
+def values_to_rgba(values, palette):
+    """
+    Look up the colors of a whole matrix of values at once.
+
+    Parameters:
+    -----------
+    values : array of ints
+        1-based indices into the palette, of any shape (e.g. (rows, cols))
+    palette : list of colors or array of shape (num_colors, 4)
+
+    Returns:
+    --------
+    Array of shape values.shape + (4,)
+    """
+    return palette_to_array(palette)[np.asarray(values) - 1]
+
+
+def values_to_gray(values, max_val):
+    """
+    Gray level of each value, from white (0) to black (max_val).
+
+    Returns:
+    --------
+    Array of shape values.shape + (4,)
+    """
+    gray = 1 - np.asarray(values) / max_val
+    rgba = np.ones(gray.shape + (4,))
+    rgba[..., :3] = gray[..., np.newaxis]
+    return rgba
+
+
+_tile_colors = palette_to_array(np.ravel(colors)).reshape(8, 8, 4)
 tiles = {
-    "top_left": [hex_to_rgba(colors[r][c]) for r in range(4) for c in range(4)],
-    "top_right": [hex_to_rgba(colors[r][c]) for r in range(4) for c in range(4, 8)],
-    "bottom_left": [hex_to_rgba(colors[r][c]) for r in range(4, 8) for c in range(4)],
-    "bottom_right": [hex_to_rgba(colors[r][c]) for r in range(4, 8) for c in range(4, 8)]
+    "top_left": [tuple(c) for c in _tile_colors[:4, :4].reshape(-1, 4)],
+    "top_right": [tuple(c) for c in _tile_colors[:4, 4:].reshape(-1, 4)],
+    "bottom_left": [tuple(c) for c in _tile_colors[4:, :4].reshape(-1, 4)],
+    "bottom_right": [tuple(c) for c in _tile_colors[4:, 4:].reshape(-1, 4)]
 }
 
 
@@ -128,259 +191,345 @@ def get_palette_set(palettes_config=None):
     
     return palettes
 
-def plot_color_grid(palettes=None):
+def cell_collection(colors, edgecolors=None, linewidth=1.0, cell_size=(1, 1)):
     """
-    Plot a grid of colored squares with different color schemes.
-    
+    Build a single collection of rectangles, one per cell.
+
     Parameters:
     -----------
-    palettes : dict or None
-        Dictionary of color palettes for each quadrant. If None, uses default palettes.
-    grid_size : tuple
-        Size of the grid (rows, columns)
-        
+    colors : array of shape (rows, cols, 4)
+        RGBA face color of each cell. Row 0 is drawn at the top.
+    edgecolors : color, array of shape (rows, cols, 4) or None
+        Edge color of each cell. If None, same as the face colors.
+    linewidth : float
+        Width of the cell edges
+    cell_size : tuple
+        Size of each cell (width, height)
+
+    Returns:
+    --------
+    PolyCollection to be added to an axis
+    """
+    from matplotlib.collections import PolyCollection
+    colors = np.asarray(colors, dtype=float)
+    rows, cols = colors.shape[:2]
+    width, height = cell_size
+    row, col = np.mgrid[0:rows, 0:cols]
+    x0 = (col * width).ravel()
+    y0 = ((rows - 1 - row) * height).ravel()
+    x1, y1 = x0 + width, y0 + height
+    verts = np.stack([
+        np.stack([x0, y0], axis=-1),
+        np.stack([x1, y0], axis=-1),
+        np.stack([x1, y1], axis=-1),
+        np.stack([x0, y1], axis=-1),
+    ], axis=1)
+    facecolors = colors.reshape(-1, 4)
+    if edgecolors is None:
+        edgecolors = facecolors
+    elif not isinstance(edgecolors, str):
+        edgecolors = np.asarray(edgecolors, dtype=float).reshape(-1, 4)
+    return PolyCollection(verts, facecolors=facecolors, edgecolors=edgecolors,
+                          linewidths=linewidth)
+
+
+QUADRANTS = ('top_left', 'top_right', 'bottom_left', 'bottom_right')
+
+
+def tiled_layout(tile_shapes, order='C'):
+    """
+    Compute the visiting order of every cell in a hierarchy of tiles.
+
+    Parameters:
+    -----------
+    tile_shapes : sequence of (rows, cols)
+        Shape of each tiling level, outermost first. E.g. ((2, 16), (16, 4))
+        is a 2x16 grid of tiles, each having 16x4 cells.
+    order : 'C', 'F' or sequence of those
+        How the sub-tiles within each level are visited: row-major ('C') or
+        column-major ('F'). A single value applies to all levels.
+
+    Returns:
+    --------
+    Int array of shape (total rows, total cols) with the position (from 0)
+    at which each cell is visited. Innermost tiles are visited completely
+    before moving on to the next one.
+    """
+    orders = [order] * len(tile_shapes) if isinstance(order, str) else list(order)
+    assert len(orders) == len(tile_shapes), "Need one order per level"
+    # visiting order is just a count, reshaped so that the slowest axis comes first
+    dims, row_axes, col_axes = [], [], []
+    for (rows, cols), level_order in zip(tile_shapes, orders):
+        if level_order == 'C':
+            row_axes.append(len(dims))
+            col_axes.append(len(dims) + 1)
+            dims += [rows, cols]
+        else:
+            col_axes.append(len(dims))
+            row_axes.append(len(dims) + 1)
+            dims += [cols, rows]
+    index = np.arange(np.prod(dims)).reshape(dims)
+    # global row = ((row0 * rows1) + row1) * rows2 + ..., same for cols
+    total_rows = int(np.prod([rows for rows, _ in tile_shapes]))
+    total_cols = int(np.prod([cols for _, cols in tile_shapes]))
+    return index.transpose(row_axes + col_axes).reshape(total_rows, total_cols)
+
+
+def tiled_colors(tile_shapes, order='C', palettes=None, per_tile=False):
+    """
+    Color of every cell in a hierarchy of tiles.
+
+    Parameters:
+    -----------
+    tile_shapes, order :
+        See tiled_layout
+    palettes : list of palettes or None
+        One palette per innermost tile (cycled if there are more tiles). Cells
+        are colored from the end of the palette to its start, in visiting order.
+    per_tile : bool
+        Without palettes, cells get darker in visiting order. If per_tile,
+        the shade restarts in every innermost tile, instead of spanning the grid.
+
+    Returns:
+    --------
+    Array of shape (total rows, total cols, 4)
+    """
+    index = tiled_layout(tile_shapes, order)
+    tile_cells = int(np.prod(tile_shapes[-1]))
+    if palettes is not None:
+        palettes = [palette_to_array(palette)[::-1] for palette in palettes]
+        for palette in palettes:
+            assert len(palette) >= tile_cells, \
+                f"Palette of {len(palette)} colors is too short for tiles of {tile_cells} cells"
+        palettes = np.stack([palette[:tile_cells] for palette in palettes])
+        tile = index // tile_cells
+        values = tile_cells - index % tile_cells
+        return palettes[tile % len(palettes), values - 1]
+    if per_tile:
+        return values_to_gray(tile_cells - index % tile_cells, tile_cells)
+    return values_to_gray(index.size - index, index.size)
+
+
+def plot_cells(colors, figsize=(10, 10), edgecolors=None, separators=None):
+    """
+    Plot a grid of colored squares.
+
+    Parameters:
+    -----------
+    colors : array of shape (rows, cols, 4)
+        Color of each cell, row 0 is at the top.
+    figsize : tuple
+        Figure size (width, height) in inches.
+    edgecolors : color or None
+        Edge color of the cells. If None, same as the cell itself.
+    separators : tuple or None
+        (rows, cols) step at which thick separator lines are drawn.
+
     Returns:
     --------
     Figure and axis objects
     """
-    # Get color palettes
-    if palettes is None:
-        palettes = get_palette_set()
-    grid_size=(8, 8)
-    # Create a figure
-    fig, ax = plt.subplots(figsize=(10, 10), frameon=False)
-    
-    # Calculate number of quadrants
-    quad_rows = grid_size[0] // 4
-    quad_cols = grid_size[1] // 4
-    
-    # Create the values matrix for each quadrant (values from 16 down to 1)
-    values = np.arange(16, 0, -1).reshape(4, 4)
-    
-    # Map quadrant positions to palette keys
-    position_mapping = {
-        (0, 0): 'top_left',
-        (0, 1): 'top_right',
-        (1, 0): 'bottom_left',
-        (1, 1): 'bottom_right'
-    }
-    
-    # Plot each cell
-    for quad_row in range(quad_rows):
-        for quad_col in range(quad_cols):
-            # Get the palette for this quadrant
-            position = (quad_row, quad_col)
-            palette_key = position_mapping.get(position, 'top_left')
-            color_palette = list(reversed(palettes[palette_key]))
-            
-            for local_row in range(4):
-                for local_col in range(4):
-                    # Calculate global row and column
-                    row = quad_row * 4 + local_row
-                    col = quad_col * 4 + local_col
-                    
-                    # Get the value for this position
-                    value = values[local_row, local_col]
-                    
-                    # Get color based on value (subtract 1 for 0-indexing)
-                    color = color_palette[value - 1]
-                    
-                    # print(color)
-                    # Plot the colored square
-                    rect = plt.Rectangle((col, grid_size[0]-1-row), 1, 1, 
-                                         facecolor=color, edgecolor='gray')
-                    ax.add_patch(rect)
-    
+    plt = get_pyplot()
+    rows, cols = colors.shape[:2]
+    fig, ax = plt.subplots(figsize=figsize, frameon=False)
+
+    # Plot all the colored squares at once
+    ax.add_collection(cell_collection(colors, edgecolors=edgecolors))
+
     # Set the axis limits and remove ticks
-    ax.set_xlim(0, grid_size[1])
-    ax.set_ylim(0, grid_size[0])
+    ax.set_xlim(0, cols)
+    ax.set_ylim(0, rows)
     ax.set_xticks([])
     ax.set_yticks([])
     ax.set_aspect('equal')
     ax.axis('off')
-    for a in [0,4,8]:
-        ax.axhline(y=a, color='black', linestyle='-', linewidth=5)
-        ax.axvline(x=a, color='black', linestyle='-', linewidth=5)
+    if separators is not None:
+        for a in range(0, rows + 1, separators[0]):
+            ax.axhline(y=a, color='black', linestyle='-', linewidth=5)
+        for a in range(0, cols + 1, separators[1]):
+            ax.axvline(x=a, color='black', linestyle='-', linewidth=5)
 
     _ = [s.set_visible(False) for s in ax.spines.values()]
     ax.set_frame_on(False)
-    # # Add grid lines
-    # for i in range(grid_size[0] + 1):
-    #     ax.axhline(y=i, color='white', linewidth=1)
-    # for j in range(grid_size[1] + 1):
-    #     ax.axvline(x=j, color='white', linewidth=1)
-    
     plt.tight_layout()
     return fig, ax
 
-def plot_color_grid2(palettes=None):
+
+def plot_tiled_grid(tile_shapes, order='C', palettes=None, per_tile=False,
+                    figsize=(10, 10), edgecolors=None, separators=False):
     """
-    Plot a grid of colored squares with different color schemes.
+    Plot a hierarchy of tiles, e.g. cache lines within pages within blocks.
+
+    Parameters:
+    -----------
+    tile_shapes, order :
+        See tiled_layout
+    palettes, per_tile :
+        See tiled_colors
+    figsize, edgecolors :
+        See plot_cells
+    separators : bool
+        Draw thick lines around the innermost tiles
+
+    Returns:
+    --------
+    Figure and axis objects
+    """
+    colors = tiled_colors(tile_shapes, order, palettes, per_tile)
+    return plot_cells(colors, figsize, edgecolors,
+                      separators=tile_shapes[-1] if separators else None)
+
+
+def rasterize_cells(colors, scale=8, separators=None, separator_width=None, edgecolor=None):
+    """
+    Render cells straight into an image array, without matplotlib.
+
+    Parameters:
+    -----------
+    colors : array of shape (rows, cols, 4)
+        Color of each cell (floats in [0, 1]), row 0 is at the top.
+    scale : int
+        Size of each cell in pixels
+    separators : tuple or None
+        (rows, cols) step at which thick black separator lines are drawn.
+    separator_width : int or None
+        Width of the separator lines in pixels. Defaults to scale // 2.
+    edgecolor : color or None
+        If given, draw a 1 pixel border of this color around every cell.
+
+    Returns:
+    --------
+    uint8 array of shape (rows * scale, cols * scale, 4)
+    """
+    rows, cols = colors.shape[:2]
+    cells = np.round(np.asarray(colors) * 255).astype(np.uint8)
+    image = cells.repeat(scale, axis=0).repeat(scale, axis=1)
+
+    def draw_lines(step_rows, step_cols, width, color):
+        # lines are centered on the first pixel of a cell. The one after the last
+        # cell is off the image, so pull it in to show as much of it as of the first
+        ys = np.minimum(np.arange(0, rows + 1, step_rows) * scale, image.shape[0] - width % 2)
+        xs = np.minimum(np.arange(0, cols + 1, step_cols) * scale, image.shape[1] - width % 2)
+        # pixel offsets of each line around its position, clipped to the image
+        offsets = np.arange(width) - width // 2
+        ys = (ys[:, np.newaxis] + offsets).ravel()
+        xs = (xs[:, np.newaxis] + offsets).ravel()
+        image[ys[(0 <= ys) & (ys < image.shape[0])], :] = color
+        image[:, xs[(0 <= xs) & (xs < image.shape[1])]] = color
+
+    if edgecolor is not None:
+        draw_lines(1, 1, 1, np.round(np.array(to_rgba(edgecolor)) * 255))
+    if separators is not None:
+        width = separator_width or max(1, scale // 2)
+        draw_lines(*separators, width, (0, 0, 0, 255))
+    return image
+
+
+def save_png(path, image, compression=6):
+    """
+    Write an RGBA uint8 image array of shape (height, width, 4) as a PNG.
+    """
+    height, width = image.shape[:2]
+    # every scanline starts with its filter type, 0 (none)
+    raw = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    raw[:, 1:] = np.asarray(image, dtype=np.uint8).reshape(height, width * 4)
+
+    def chunk(tag, data):
+        return (struct.pack(">I", len(data)) + tag + data
+                + struct.pack(">I", zlib.crc32(tag + data)))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)  # 8 bit RGBA
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", header))
+        f.write(chunk(b"IDAT", zlib.compress(raw.tobytes(), compression)))
+        f.write(chunk(b"IEND", b""))
+
+
+def save_tiled_grid_png(path, tile_shapes, order='C', palettes=None, per_tile=False,
+                        scale=8, separators=False, edgecolor=None):
+    """
+    Raster version of plot_tiled_grid, for quick previews of huge grids.
+
+    Parameters:
+    -----------
+    path : str or Path
+        Output PNG file
+    tile_shapes, order, palettes, per_tile :
+        See tiled_colors
+    scale, edgecolor :
+        See rasterize_cells
+    separators : bool
+        Draw thick lines around the innermost tiles
+    """
+    colors = tiled_colors(tile_shapes, order, palettes, per_tile)
+    image = rasterize_cells(colors, scale, tile_shapes[-1] if separators else None,
+                            edgecolor=edgecolor)
+    save_png(path, image)
+
+
+# name: arguments of the tiled FIGURES, shared by their matplotlib and raster renderings
+TILED_FIGURES = {
+    "grid": dict(tile_shapes=((2, 2), (4, 4)), order='C', edgecolors='gray', separators=True),
+    "grid2": dict(tile_shapes=((2, 16), (16, 4)), order=('C', 'F'), per_tile=True),
+    "grid3": dict(tile_shapes=((2, 16), (16, 4)), order='C'),
+}
+
+
+def tiled_figure_args(name, palettes=None):
+    """plot_tiled_grid arguments of one of the TILED_FIGURES, without figsize"""
+    args = dict(TILED_FIGURES[name])
+    if name == "grid":
+        if palettes is None:
+            palettes = get_palette_set()
+        args["palettes"] = [palettes[key] for key in QUADRANTS]
+    return args
+
+
+def plot_color_grid(palettes=None):
+    """
+    Plot a 2x2 grid of quadrants, each with a 4x4 grid of cells colored from
+    its own palette.
     
     Parameters:
     -----------
     palettes : dict or None
         Dictionary of color palettes for each quadrant. If None, uses default palettes.
+        
     Returns:
     --------
     Figure and axis objects
     """
-    # Get color palettes
-    if palettes is None:
-        palettes = get_palette_set()
-    grid_size=(32, 64)
-    # Create a figure
-    fig, ax = plt.subplots(figsize=(10, 20), frameon=False)
-    
-    # Calculate number of quadrants
-    # quad_rows = grid_size[0] // 2
-    quad_rows = 2
-    quad_cols = 16
-
-    # assert it is perfectly divisible
-    quad_size_rows = grid_size[0] // quad_rows
-    quad_size_cols = grid_size[1] // quad_cols
-    # quad_cols = grid_size[1] // 16
-    
-    # Create the values matrix for each quadrant (values from 16 down to 1)
-    quad_size = quad_size_rows * quad_size_cols
-    values = np.arange(quad_size, 0, -1).reshape((quad_size_rows, quad_size_cols), order='F')
-    print(values)
-    
-    # Map quadrant positions to palette keys
-    position_mapping = {
-        (0, 0): 'top_left',
-        (0, 1): 'top_right',
-        (1, 0): 'bottom_left',
-        (1, 1): 'bottom_right'
-    }
-    
-    # Plot each cell
-    for quad_row in range(quad_rows):
-        for quad_col in range(quad_cols):
-            # Get the palette for this quadrant
-            position = (quad_row, quad_col)
-            palette_key = position_mapping.get(position, 'top_left')
-            color_palette = list(reversed(palettes[palette_key]))
-            for local_col in range(quad_size_cols):
-                for local_row in range(quad_size_rows):
-                    # Calculate global row and column
-                    row = quad_row * quad_size_rows + local_row
-                    col = quad_col * quad_size_cols + local_col
-                    
-                    # Get the value for this position
-                    value = values[local_row, local_col]
-                    
-                    color_gray_val = 1 - (value / quad_size)
-                    color = tuple(np.repeat(color_gray_val, 3)) + (1.,)
-                    
-                    # print(color)
-                    # Plot the colored square
-                    rect = plt.Rectangle((col, grid_size[0]-1-row), 1, 1, 
-                                         facecolor=color, edgecolor=color)
-                    ax.add_patch(rect)
-    
-    # Set the axis limits and remove ticks
-    ax.set_xlim(0, grid_size[1])
-    ax.set_ylim(0, grid_size[0])
-    ax.set_xticks([])
-    ax.set_yticks([])
-    ax.set_aspect('equal')
-    ax.axis('off')
-    # for a in [0,4,8]:
-    #     ax.axhline(y=a, color='black', linestyle='-', linewidth=5)
-    #     ax.axvline(x=a, color='black', linestyle='-', linewidth=5)
+    return plot_tiled_grid(**tiled_figure_args("grid", palettes), figsize=(10, 10))
 
-    _ = [s.set_visible(False) for s in ax.spines.values()]
-    ax.set_frame_on(False)
-    # # Add grid lines
-    # for i in range(grid_size[0] + 1):
-    #     ax.axhline(y=i, color='white', linewidth=1)
-    # for j in range(grid_size[1] + 1):
-    #     ax.axvline(x=j, color='white', linewidth=1)
+def plot_color_grid2(palettes=None):
+    """
+    Plot a 2x16 grid of 16x4 tiles, shaded in column-major order within each tile.
     
-    plt.tight_layout()
-    return fig, ax
+    Parameters:
+    -----------
+    palettes : dict or None
+        Unused, kept for symmetry with plot_color_grid.
+    Returns:
+    --------
+    Figure and axis objects
+    """
+    return plot_tiled_grid(**tiled_figure_args("grid2"), figsize=(10, 20))
 
 def plot_color_grid3(palettes=None):
     """
-    Plot a grid of colored squares with different color schemes.
+    Plot a 2x16 grid of 16x4 tiles, shaded across the whole grid in
+    row-major order of the tiles and their cells.
     
     Parameters:
     -----------
     palettes : dict or None
-        Dictionary of color palettes for each quadrant. If None, uses default palettes.
+        Unused, kept for symmetry with plot_color_grid.
     Returns:
     --------
     Figure and axis objects
     """
-    # Get color palettes
-    if palettes is None:
-        palettes = get_palette_set()
-    grid_size=(32, 64)
-    # Create a figure
-    fig, ax = plt.subplots(figsize=(10, 20), frameon=False)
-    
-    # Calculate number of quadrants
-    # quad_rows = grid_size[0] // 2
-    quad_rows = 2
-    quad_cols = 16
-
-    # assert it is perfectly divisible
-    quad_size_rows = grid_size[0] // quad_rows
-    quad_size_cols = grid_size[1] // quad_cols
-    # quad_cols = grid_size[1] // 16
-    
-    # Create the values matrix for each quadrant (values from 16 down to 1)
-    quad_size = quad_size_rows * quad_size_cols
-    values = np.arange(grid_size[0] * grid_size[1], 0, -1).reshape((quad_rows, quad_cols, quad_size_rows, quad_size_cols), order='C')
-    print(values)
-    max_val = grid_size[0] * grid_size[1]
-    # Map quadrant positions to palette keys
-    
-    # Plot each cell
-    for quad_row in range(quad_rows):
-        for quad_col in range(quad_cols):
-            # Get the palette for this quadrant
-            for local_col in range(quad_size_cols):
-                for local_row in range(quad_size_rows):
-                    # Calculate global row and column
-                    row = quad_row * quad_size_rows + local_row
-                    col = quad_col * quad_size_cols + local_col
-                    
-                    # Get the value for this position
-                    value = values[quad_row, quad_col, local_row, local_col]
-                    
-                    color_gray_val = 1 - (value / max_val)
-                    color = tuple(np.repeat(color_gray_val, 3)) + (1.,)
-                    
-                    # print(color)
-                    # Plot the colored square
-                    rect = plt.Rectangle((col, grid_size[0]-1-row), 1, 1, 
-                                         facecolor=color, edgecolor=color)
-                    ax.add_patch(rect)
-    
-    # Set the axis limits and remove ticks
-    ax.set_xlim(0, grid_size[1])
-    ax.set_ylim(0, grid_size[0])
-    ax.set_xticks([])
-    ax.set_yticks([])
-    ax.set_aspect('equal')
-    ax.axis('off')
-    # for a in [0,4,8]:
-    #     ax.axhline(y=a, color='black', linestyle='-', linewidth=5)
-    #     ax.axvline(x=a, color='black', linestyle='-', linewidth=5)
-
-    _ = [s.set_visible(False) for s in ax.spines.values()]
-    ax.set_frame_on(False)
-    # # Add grid lines
-    # for i in range(grid_size[0] + 1):
-    #     ax.axhline(y=i, color='white', linewidth=1)
-    # for j in range(grid_size[1] + 1):
-    #     ax.axvline(x=j, color='white', linewidth=1)
-    
-    plt.tight_layout()
-    return fig, ax
+    return plot_tiled_grid(**tiled_figure_args("grid3"), figsize=(10, 20))
 
 def plot_color_line(palettes=None, grid_size=(8, 8)):
     """
@@ -397,6 +546,7 @@ def plot_color_line(palettes=None, grid_size=(8, 8)):
     --------
     Figure and axis objects
     """
+    plt = get_pyplot()
     fig, ax = plt.subplots(figsize=(12, 3), frameon=False)
     # Get color palettes
     if palettes is None:
@@ -404,14 +554,13 @@ def plot_color_line(palettes=None, grid_size=(8, 8)):
     
     # Flatten all palettes into a single list
     all_colors = []
-    for key in ['top_left', 'top_right', 'bottom_left', 'bottom_right']:
+    for key in QUADRANTS:
         all_colors.extend(palettes[key])
     
     # Plot each cell in a linear arrangement
     num_cells = len(all_colors)
-    for i, color in enumerate(all_colors):
-        rect = plt.Rectangle((i, 0), 1, 5, linewidth=1, facecolor=color, edgecolor=color)
-        ax.add_patch(rect)
+    colors = np.array(all_colors, dtype=float).reshape(1, num_cells, -1)
+    ax.add_collection(cell_collection(colors, linewidth=1, cell_size=(1, 5)))
     
     # Set axis limits and remove ticks
     ax.set_xlim(0, num_cells)
@@ -454,7 +603,7 @@ def create_quadrant_grid(figsize=(10, 10), grid_size=4, colormaps=None):
         colormaps = list(get_palette_set().values())
     
     # Create figure and axis
-    fig, ax = plt.subplots(figsize=figsize)
+    fig, ax = get_pyplot().subplots(figsize=figsize)
     
     # Turn off axis
     ax.axis('off')
@@ -482,6 +631,7 @@ def create_quadrant_grid(figsize=(10, 10), grid_size=4, colormaps=None):
                     values[global_row, global_col] = value
     
     # Create the grid of colored cells
+    colors = np.zeros((total_size, total_size, 4))
     for i in range(total_size):
         for j in range(total_size):
             # Determine which quadrant this cell belongs to
@@ -497,12 +647,9 @@ def create_quadrant_grid(figsize=(10, 10), grid_size=4, colormaps=None):
             norm_value = (value - 1) / (grid_size * grid_size - 1)  # Normalized between 0 and 1
             
             # Get color from colormap
-            color = cmap[i * grid_size + j]
-            
-            # Create rectangle for the cell
-            rect = plt.Rectangle((j, total_size - i - 1), 1, 1, 
-                               facecolor=color, edgecolor='white', linewidth=0.5)
-            ax.add_patch(rect)
+            colors[i, j] = cmap[(i % grid_size) * grid_size + j % grid_size]
+
+    ax.add_collection(cell_collection(colors, edgecolors='white', linewidth=0.5))
     
     # Set limits for the axis
     ax.set_xlim(0, total_size)
@@ -521,17 +668,64 @@ def create_quadrant_grid(figsize=(10, 10), grid_size=4, colormaps=None):
     ax.set_aspect('equal')
     
     return fig, ax
-# Example usage:
-fig, ax = plot_color_grid()
-# fig, ax = create_quadrant_grid()
-plt.savefig("grid.svg")
-# plt.show()
-plt.close()
-fig, ax = plot_color_line()
-plt.savefig("line.svg")
-plt.close()
-fig, ax = plot_color_grid3()
-plt.savefig("grid3.svg")
+# name: figure function
+FIGURES = {
+    "grid": plot_color_grid,
+    "grid2": plot_color_grid2,
+    "grid3": plot_color_grid3,
+    "line": plot_color_line,
+    "quadrants": create_quadrant_grid,
+}
+
+
+def render_figure(name, output_dir=Path("."), fmt="svg", raster_scale=None):
+    """Render one of the FIGURES to output_dir/name.fmt
+
+    With raster_scale, TILED_FIGURES are rasterized to output_dir/name.png
+    instead, raster_scale pixels per cell, without matplotlib."""
+    if raster_scale is not None and name in TILED_FIGURES:
+        args = tiled_figure_args(name)
+        edgecolor = args.pop("edgecolors", None)
+        output = Path(output_dir) / f"{name}.png"
+        save_tiled_grid_png(output, **args, scale=raster_scale, edgecolor=edgecolor)
+        return output
+    import matplotlib
+    matplotlib.use("Agg")
+    plt = get_pyplot()
+    fig, ax = FIGURES[name]()
+    output = Path(output_dir) / f"{name}.{fmt}"
+    fig.savefig(output)
+    plt.close(fig)
+    return output
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render tiled grid figures")
+    parser.add_argument("figures", nargs="*", metavar="figure",
+                        help=f"Any of {', '.join(FIGURES)} (default: grid line grid3)")
+    parser.add_argument("--output-dir", type=Path, default=Path("."))
+    parser.add_argument("--format", default="svg", help="Any format savefig supports")
+    parser.add_argument("--raster", action="store_true",
+                        help=f"Render {', '.join(TILED_FIGURES)} straight to PNG, without matplotlib")
+    parser.add_argument("--scale", type=int, default=8, help="Pixels per cell with --raster")
+    parser.add_argument("--num-procs", type=int, default=1,
+                        help="Render figures in parallel, one per process")
+    args = parser.parse_args()
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    figures = args.figures or ["grid", "line", "grid3"]
+    if unknown := set(figures) - FIGURES.keys():
+        parser.error(f"Unknown figures: {', '.join(sorted(unknown))}")
+    jobs = [(name, args.output_dir, args.format, args.scale if args.raster else None)
+            for name in figures]
+    if args.num_procs > 1 and len(jobs) > 1:
+        with Pool(min(args.num_procs, len(jobs))) as pool:
+            outputs = pool.starmap(render_figure, jobs)
+    else:
+        outputs = [render_figure(*job) for job in jobs]
+    for output in outputs:
+        print("Saved", output)
+
+
 # Custom palette example:
 """
 custom_palettes = get_palette_set({
@@ -543,3 +737,7 @@ custom_palettes = get_palette_set({
 fig, ax = plot_color_grid(palettes=custom_palettes)
 plt.show()
 """
+
+
+if __name__ == '__main__':
+    main()
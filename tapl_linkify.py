@@ -1,127 +1,388 @@
+"""Add cross-reference links to pdfs, as declared by the rules in a json file.
+
+Each rule links every anchor to the target with the same key, eg:
+
+    {"rules": [{
+        "name": "exercises",
+        "anchor": {"pattern": "(?P<key>.+)", "followed_by": "Exercise", "max_x0": 200, "pages": [0, 512]},
+        "target": {"pattern": "(?P<key>.+)", "followed_by": "Solution:", "max_x0": 200, "pages": [514, 587]},
+        "key": "section",
+        "backlink": true,
+        "warn_unmatched": ["target"]
+    }]}
+
+Anchors and targets match single words: "pattern" is searched in the word and its
+"key" group (or the whole match) is the join key. Optionally the next word has to be
+"followed_by", the word has to start left of "max_x0", and its page has to be in
+"pages" ([start, stop), either can be null). A target can instead be {"toc": pattern},
+matched against the table of contents, linking to the entry's page.
+"key" is how keys are compared: "string" or "section" (section numbers, 2.03 == 2.3).
+"""
+import argparse
 import fitz
-from typing import NamedTuple
-from packaging.version import Version, InvalidVersion
+import hashlib
+import json
+import math
+import numpy as np
+import os
+import sys
+from multiprocessing import Pool
+from typing import NamedTuple, Optional, Union
 from pathlib import Path
 import re
 
-path = Path("~/Books/Types and Programming Languages.bak.pdf").expanduser()
-mupdf = fitz.open(path)
-SEC_REF_PAT = re.compile(r"§(?P<sec_num>\d+(\.\d+)*)")
+CACHE_DIR = Path("~/.cache/tapl_linkify").expanduser()
+RULES_FILE = Path(__file__).with_name("tapl_linkify.json")
+SECTION_NUM_PAT = re.compile(r"\d+(\.\d+)*")
+
+
+class PdfWords:
+    """Words of every page of a pdf, as given by page.get_text("words").
+
+    Text extraction is the slow part, so it is done once for the whole pdf,
+    and stored columnar: word rects in a numpy array, strings in a list.
+    """
+
+    def __init__(self, rects: np.ndarray, strings: list, page_starts: np.ndarray):
+        self.rects = rects  # (num words, 4)
+        self.strings = strings
+        self.page_starts = page_starts  # index of first word of each page, and the end
 
+    def __len__(self):
+        return len(self.page_starts) - 1
 
-class FoundTextBox(NamedTuple):
-    string: str
-    rect: fitz.Rect
+    @classmethod
+    def extract(cls, doc: fitz.Document, start=0, stop=None):
+        rects, strings, page_starts = [], [], [0]
+        for page in doc.pages(start, stop):
+            for data in page.get_text("words"):
+                rects.append(data[:4])
+                strings.append(data[4])
+            page_starts.append(len(strings))
+        return cls(np.array(rects, dtype=np.float64).reshape(-1, 4), strings,
+                   np.array(page_starts, dtype=np.int64))
 
+    @classmethod
+    def concat(cls, parts: list):
+        """Join the words of consecutive page ranges"""
+        offsets = np.cumsum([0] + [len(part.strings) for part in parts[:-1]])
+        page_starts = [part.page_starts[:-1] + offset for part, offset in zip(parts, offsets)]
+        page_starts.append([sum(len(part.strings) for part in parts)])
+        return cls(np.concatenate([part.rects for part in parts]),
+                   [string for part in parts for string in part.strings],
+                   np.concatenate(page_starts))
 
-class VersionedEntity(NamedTuple):
-    """Anything that is stringified as a version (eg: 2.3.4)
+    def page(self, pagenum: int):
+        """Words of a page as (x0, y0, x1, y1, word) tuples"""
+        start, end = self.page_starts[pagenum], self.page_starts[pagenum + 1]
+        return [(*rect, string) for rect, string in
+                zip(self.rects[start:end].tolist(), self.strings[start:end])]
 
-    A hack to get comparison operators between section numbers for free.
+    def pages(self, start=0, stop=None):
+        """(pagenum, words) for each page, page range works like Document.pages"""
+        stop = len(self) if stop is None else min(stop, len(self))
+        for pagenum in range(start, stop):
+            yield pagenum, self.page(pagenum)
 
-    FIXME: We don't really need comparison operators now that we're doing hashjoin.
-        Better to replace with regex matching. Would be cheaper.
+    def save(self, file: Path):
+        # words never contain whitespace, so they can be stored newline separated
+        strings = np.frombuffer("\n".join(self.strings).encode(), dtype=np.uint8)
+        np.savez(file, rects=self.rects, page_starts=self.page_starts, strings=strings)
+
+    @classmethod
+    def load(cls, file: Path):
+        with np.load(file) as data:
+            strings = data["strings"].tobytes().decode()
+            return cls(data["rects"], strings.split("\n") if strings else [],
+                       data["page_starts"])
+
+    def save_cache(self, cache_file: Path):
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        # the pid keeps concurrent jobs on identical pdfs from sharing a temp file
+        tmp_file = cache_file.with_name(f"{cache_file.stem}.{os.getpid()}.tmp.npz")
+        self.save(tmp_file)
+        os.replace(tmp_file, cache_file)
+
+    @staticmethod
+    def cache_file(pdf_path: Path, cache_dir=CACHE_DIR):
+        """Cache location for the words of pdf_path, named by its contents"""
+        digest = hashlib.sha256()
+        with open(pdf_path, "rb") as f:
+            while chunk := f.read(1 << 20):
+                digest.update(chunk)
+        return cache_dir / f"{digest.hexdigest()}.npz"
+
+
+def section_key(string: str):
+    """Section numbers (eg: 2.3.4) as tuples of ints, None if string isn't one
+
+    Trailing zeros are dropped like packaging's Version did, so 2.3.0 joins with 2.3
     """
-    version: Version
-    rect: fitz.Rect
+    if not SECTION_NUM_PAT.fullmatch(string):
+        return None
+    key = tuple(map(int, string.split(".")))
+    while key[-1] == 0 and len(key) > 1:
+        key = key[:-1]
+    return key
+
+
+def format_section_key(key: tuple):
+    """Section number as users see it, eg: (2, 3, 4) -> 2.3.4"""
+    return ".".join(map(str, key))
+
+
+# key normalizers return None for strings that aren't valid keys
+KEY_TYPES = {"string": str, "section": section_key}
+KEY_FORMATS = {"string": str, "section": format_section_key}
+
+
+def match_key(pattern: re.Pattern, string: str):
+    """The "key" group of pattern in string, or the whole match, None if no match"""
+    if match := pattern.search(string):
+        return match["key"] if "key" in pattern.groupindex else match[0]
+    return None
+
+
+class Entity(NamedTuple):
+    """A linkable thing on a page: an anchor or a target of a rule"""
+    key: object
+    rect: Optional[fitz.Rect]  # None for the whole page
     pagenum: int
 
 
-def find_before_target(page: fitz.Page, target: str, margin=200):
-    """Find the text _before_ the target word only if text.x0 < margin"""
-    prev = None
-    for data in page.get_text("words"):
-        string = data[4]
-        if prev and string == target and prev[0] < margin:
-            yield FoundTextBox(prev[4], fitz.Rect(prev[:4]))
-        prev = data
-
-
-def get_all_entities(search_str: str, page_start: int, page_end: int):
-    """Search for versioned entities between given pages"""
-    for page in mupdf.pages(page_start, page_end):
-        for found_box in find_before_target(page, search_str):
-            try:
-                ver = Version(found_box.string)
-            except InvalidVersion:
-                print("Weird entity:", found_box)
-            else:
-                yield VersionedEntity(ver, found_box.rect, page.number)
-
-
-def add_link(source: VersionedEntity, target: VersionedEntity):
-    src_page = mupdf[source.pagenum]
-    target_point = target.rect.top_left
-    src_page.insert_link({
+class WordMatcher(NamedTuple):
+    """Matches single words of a page, eg: the "2.3.4" in "2.3.4 Exercise" """
+    pattern: re.Pattern
+    key_type: str
+    followed_by: Optional[str]
+    max_x0: float
+    pages: tuple  # [start, stop)
+
+    @classmethod
+    def from_config(cls, cfg: dict, key_type: str):
+        start, stop = cfg.get("pages") or (0, None)
+        return cls(re.compile(cfg["pattern"]), key_type, cfg.get("followed_by"),
+                   cfg.get("max_x0", math.inf), (start or 0, math.inf if stop is None else stop))
+
+    def on_page(self, pagenum: int):
+        return self.pages[0] <= pagenum < self.pages[1]
+
+    def match(self, words: list, i: int):
+        """Key string of words[i] if it matches, else None"""
+        data = words[i]
+        if data[0] >= self.max_x0:
+            return None
+        if self.followed_by is not None and (i + 1 == len(words) or words[i + 1][4] != self.followed_by):
+            return None
+        return match_key(self.pattern, data[4])
+
+
+class TocMatcher(NamedTuple):
+    """Matches entries of the table of contents, the target is the entry's page"""
+    pattern: re.Pattern
+    key_type: str
+
+    @classmethod
+    def from_config(cls, cfg: dict, key_type: str):
+        return cls(re.compile(cfg["toc"]), key_type)
+
+    def find(self, doc: fitz.Document):
+        normalize = KEY_TYPES[self.key_type]
+        for level, name, page_num in doc.get_toc():
+            if (key_str := match_key(self.pattern, name)) is not None:
+                if (key := normalize(key_str)) is not None:
+                    yield Entity(key, None, page_num - 1)
+
+
+def make_matcher(cfg: dict, key_type: str):
+    return TocMatcher.from_config(cfg, key_type) if "toc" in cfg else WordMatcher.from_config(cfg, key_type)
+
+
+class Rule(NamedTuple):
+    """Link every anchor to the target with the same key"""
+    name: str
+    anchor: WordMatcher
+    target: Union[WordMatcher, TocMatcher]
+    backlink: bool  # also link each target back to its anchor
+    warn_unmatched: tuple  # "anchor" and/or "target"
+
+    @classmethod
+    def from_config(cls, cfg: dict):
+        key_type = cfg.get("key", "string")
+        if key_type not in KEY_TYPES:
+            raise ValueError(f"Rule {cfg['name']}: unknown key type {key_type}, expected one of {list(KEY_TYPES)}")
+        if "toc" in cfg["anchor"]:
+            raise ValueError(f"Rule {cfg['name']}: anchors must be words, not toc entries")
+        target = make_matcher(cfg["target"], key_type)
+        backlink = cfg.get("backlink", False)
+        if backlink and isinstance(target, TocMatcher):
+            raise ValueError(f"Rule {cfg['name']}: can't link back from toc entries")
+        return cls(cfg["name"], make_matcher(cfg["anchor"], key_type), target, backlink,
+                   tuple(cfg.get("warn_unmatched", ("anchor", "target"))))
+
+    @property
+    def word_matchers(self):
+        return [m for m in (self.anchor, self.target) if isinstance(m, WordMatcher)]
+
+
+def rule_matchers(rules: list):
+    """Word matchers of all rules, a matcher shared by rules is only scanned for once"""
+    return list(dict.fromkeys(m for rule in rules for m in rule.word_matchers))
+
+
+def load_rules(file: Path):
+    with open(file) as f:
+        return [Rule.from_config(rule) for rule in json.load(f)["rules"]]
+
+
+def scan_words(words: PdfWords, matchers: list, first_page=0):
+    """Entities of each matcher, found in a single pass over the words of each page
+
+    first_page is the pagenum of words.page(0).
+    """
+    found = [[] for _ in matchers]
+    for i, page_words in words.pages():
+        pagenum = first_page + i
+        active = [(j, m, KEY_TYPES[m.key_type]) for j, m in enumerate(matchers) if m.on_page(pagenum)]
+        if not active:
+            continue
+        for w, data in enumerate(page_words):
+            for j, matcher, normalize in active:
+                if (key_str := matcher.match(page_words, w)) is None:
+                    continue
+                if (key := normalize(key_str)) is None:
+                    print(f"Weird entity on page {pagenum}:", key_str)
+                else:
+                    found[j].append(Entity(key, fitz.Rect(data[:4]), pagenum))
+    return found
+
+
+def scan_range(pdf_path: Path, start: int, stop: int, matchers: list):
+    """Worker: scan pages [start, stop) of pdf_path, with its own document handle"""
+    with fitz.open(pdf_path) as doc:
+        words = PdfWords.extract(doc, start, stop)
+    return words, scan_words(words, matchers, start)
+
+
+def page_ranges(num_pages: int, num_chunks: int):
+    bounds = np.linspace(0, num_pages, num_chunks + 1).astype(int)
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:]) if start < stop]
+
+
+def scan_pages(pdf_path: Path, num_pages: int, matchers: list, num_procs: int):
+    """Extract and scan the words of all pages, spread over num_procs processes"""
+    if num_procs <= 1:
+        return scan_range(pdf_path, 0, num_pages, matchers)
+    # a few chunks per process, so a slow range of pages doesn't hold up the rest
+    ranges = page_ranges(num_pages, num_procs * 4)
+    with Pool(num_procs) as pool:
+        results = pool.starmap(scan_range, [(pdf_path, start, stop, matchers) for start, stop in ranges])
+    words, scans = zip(*results)
+    return PdfWords.concat(list(words)), [sum(found, []) for found in zip(*scans)]
+
+
+def scan_pdf(pdf_path: Path, num_pages: int, matchers: list, num_procs=1):
+    """Scan from the cached words of pdf_path, or extract them in parallel on a miss"""
+    cache_file = PdfWords.cache_file(pdf_path)
+    try:
+        return scan_words(PdfWords.load(cache_file), matchers)
+    except FileNotFoundError:
+        pass
+    words, found = scan_pages(pdf_path, num_pages, matchers, num_procs)
+    words.save_cache(cache_file)
+    return found
+
+
+def add_link(doc: fitz.Document, source: Entity, target: Entity):
+    link = {
         'kind': fitz.LINK_GOTO,
         'from': source.rect,
         'page': target.pagenum,
-        'to': target_point,
-        'zoom': 0.0
-    })
-
+    }
+    if target.rect is not None:
+        link.update({'to': target.rect.top_left, 'zoom': 0.0})
+    doc[source.pagenum].insert_link(link)
 
-def link_exercises_and_solutions():
-    all_exercises = get_all_entities("Exercise", 0, 512)
-    all_solutions = get_all_entities("Solution:", 514, 587)
 
-    # do a hashjoin of exercises and solutions
-    solutions_dict = {sol.version: sol for sol in all_solutions}
+def link_rule(doc: fitz.Document, rule: Rule, anchors: list, targets: list):
+    """Hashjoin anchors and targets on their keys, returns the number of links added"""
+    name = Path(doc.name).name
+    format_key = KEY_FORMATS[rule.anchor.key_type]
+    targets_dict = {target.key: target for target in targets}
     found = set()
+    num_links = 0
 
-    for exercise in all_exercises:
-        if solution := solutions_dict.get(exercise.version):
-            found.add(solution.version)
-            # print("MATCH!", solution, exercise)
-            add_link(exercise, solution)
-            add_link(solution, exercise)
-
-    for solution in set(solutions_dict.keys()).difference(found):
-        print("Warning: No corresponding exercise found for", solution)
-
-
-def get_sections():
-    for entry in mupdf.get_toc():
-        level, name, page_num = entry
-        page_num: int
-        try:
-            section_str, _ = name.split(" ", maxsplit=1)
-            yield str(Version(section_str)), page_num - 1
-        except (ValueError, IndexError, TypeError, InvalidVersion):
-            continue
+    for anchor in anchors:
+        if target := targets_dict.get(anchor.key):
+            found.add(target.key)
+            add_link(doc, anchor, target)
+            num_links += 1
+            if rule.backlink:
+                add_link(doc, target, anchor)
+                num_links += 1
+        elif "anchor" in rule.warn_unmatched:
+            print(f"Warning: {name}: {rule.name}: No target found for", format_key(anchor.key))
+
+    if "target" in rule.warn_unmatched:
+        for key in set(targets_dict.keys()).difference(found):
+            print(f"Warning: {name}: {rule.name}: No anchor found for", format_key(key))
+    return num_links
 
 
-def get_section_refs(page: fitz.Page):
-    for data in page.get_text("words"):
-        word: str = data[4]
-        if "§" in word:
-            if ver_str := SEC_REF_PAT.search(word):
-                yield fitz.Rect(data[:4]), ver_str["sec_num"]
-            else:
-                print("Weird section num", word)
+def link_pdf(pdf_path: Path, rules: list, output: Path, num_procs=1):
+    """Add the links of all rules to pdf_path, saving it as output"""
+    with fitz.open(pdf_path) as doc:
+        matchers = rule_matchers(rules)
+        found = dict(zip(matchers, scan_pdf(pdf_path, len(doc), matchers, num_procs)))
+        num_links = 0
+        for rule in rules:
+            targets = rule.target.find(doc) if isinstance(rule.target, TocMatcher) else found[rule.target]
+            num_links += link_rule(doc, rule, found[rule.anchor], targets)
+        doc.save(output)
+    return num_links
 
 
-def link_section_refs():
-    section_index = dict(get_sections())
+def _link_pdf_job(args):
+    pdf_path, *_ = args
+    try:
+        return pdf_path, link_pdf(*args), None
+    except Exception as e:
+        return pdf_path, None, e
 
-    for page in mupdf.pages():
-        for rect, sec_ref in get_section_refs(page):
-            try:
-                target_page_num = section_index[sec_ref]
-            except KeyError:
-                print("Warning: Could not find page number for section", sec_ref)
-            else:
-                page.insert_link({
-                    'kind': fitz.LINK_GOTO,
-                    'from': rect,
-                    'page': target_page_num,
-                })
+
+def report(results):
+    """Print the outcome of each job, returns the number of failed ones"""
+    failed = 0
+    for pdf_path, num_links, error in results:
+        if error is None:
+            print(f"{pdf_path}: added {num_links} links")
+        else:
+            failed += 1
+            print(f"Error: {pdf_path}: {error!r}")
+    return failed
 
 
 def main():
-    link_exercises_and_solutions()
-    link_section_refs()
-    mupdf.save(path.with_name("temp.pdf"))
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("pdfs", type=Path, nargs="+")
+    parser.add_argument("--rules", type=Path, default=RULES_FILE, help="json file with the link rules")
+    parser.add_argument("--output-dir", type=Path, help="Defaults to the directory of each pdf")
+    parser.add_argument("--num-procs", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    rules = load_rules(args.rules)
+    if args.output_dir:
+        args.output_dir.mkdir(parents=True, exist_ok=True)
+    jobs = [(pdf, rules, (args.output_dir or pdf.parent) / f"{pdf.stem}.linked.pdf")
+            for pdf in args.pdfs]
+
+    if len(jobs) == 1:
+        # a single pdf gets its pages scanned in parallel instead
+        failed = report([_link_pdf_job((*jobs[0], args.num_procs))])
+    else:
+        with Pool(min(args.num_procs, len(jobs))) as pool:
+            failed = report(pool.imap_unordered(_link_pdf_job, jobs))
+    sys.exit(failed > 0)
 
 
 if __name__ == '__main__':
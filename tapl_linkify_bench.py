@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""Speedup of the page-parallel scan in tapl_linkify, on a cold word cache.
+
+With --keys, the per word cost of the section key normalizer instead."""
+import argparse
+import time
+from pathlib import Path
+
+import fitz
+
+import tapl_linkify
+
+
+def bench_scan(pdf_path: Path, num_pages: int, matchers: list, procs: int, repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        tapl_linkify.scan_pages(pdf_path, num_pages, matchers, procs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def version_key(string: str):
+    """The packaging.Version normalizer section_key replaced"""
+    from packaging.version import Version, InvalidVersion
+    try:
+        return Version(string)
+    except InvalidVersion:
+        return None
+
+
+def bench_keys(pdf_path: Path, repeat: int):
+    cache_file = tapl_linkify.PdfWords.cache_file(pdf_path)
+    try:
+        words = tapl_linkify.PdfWords.load(cache_file)
+    except FileNotFoundError:
+        with fitz.open(pdf_path) as doc:
+            words = tapl_linkify.PdfWords.extract(doc)
+    strings = words.strings
+    print(f"{pdf_path} ({len(strings)} words)")
+    for name, normalize in (("packaging.Version", version_key), ("section_key", tapl_linkify.section_key)):
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            num_keys = sum(normalize(string) is not None for string in strings)
+            best = min(best, time.perf_counter() - start)
+        print(f"{name:<18} {best:8.3f}s {best / len(strings) * 1e9:8.0f} ns/word "
+              f"{num_keys} keys")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("pdf", type=Path)
+    parser.add_argument("--rules", type=Path, default=tapl_linkify.RULES_FILE)
+    parser.add_argument("--procs", type=lambda s: [int(x) for x in s.split(",")],
+                        default=[1, 2, 4, 8], help="Comma separated process counts")
+    parser.add_argument("--repeat", type=int, default=3, help="Best of this many runs")
+    parser.add_argument("--keys", action="store_true", help="Benchmark the key normalizers instead")
+    args = parser.parse_args()
+
+    if args.keys:
+        return bench_keys(args.pdf, args.repeat)
+
+    matchers = tapl_linkify.rule_matchers(tapl_linkify.load_rules(args.rules))
+    with fitz.open(args.pdf) as doc:
+        num_pages = len(doc)
+    print(f"{args.pdf} ({num_pages} pages)")
+    baseline = None
+    for procs in args.procs:
+        secs = bench_scan(args.pdf, num_pages, matchers, procs, args.repeat)
+        baseline = baseline or secs
+        print(f"procs={procs:<3} {secs:8.3f}s {num_pages / secs:8.0f} pages/s "
+              f"{baseline / secs:6.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,14 @@
 #!/usr/bin/env python
 import difflib
+import hashlib
+import heapq
 import json
 import os
 import re
+import shutil
 import sys
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 script_dir = Path(__file__).parent
@@ -29,69 +34,154 @@ def load_config():
     return cfg
 
 
-def find_appl_dir(viv_dir):
+def find_appl_dirs(viv_dir):
+    """All installed versions, newest first."""
     if os.name != 'nt':
-        return viv_dir
-    for appl_dir in list(viv_dir.iterdir()):
-        if appl_dir.is_dir() and re.match(r'(\d+\.){3}\d+', appl_dir.name):
-            return appl_dir
+        return [viv_dir]
+    appl_dirs = [appl_dir for appl_dir in viv_dir.iterdir()
+                 if appl_dir.is_dir() and re.fullmatch(r'(\d+\.){3}\d+', appl_dir.name)]
+    return sorted(appl_dirs, key=lambda d: tuple(map(int, d.name.split('.'))), reverse=True)
+
+
+def find_appl_dir(viv_dir):
+    for appl_dir in find_appl_dirs(viv_dir):
+        return appl_dir
 
     print("Couldn't determine app folder!")
     exit(1)
 
 
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.digest()
+
+
+def same_contents(src, dest):
+    try:
+        if src.stat().st_size != dest.stat().st_size:
+            return False
+    except FileNotFoundError:
+        return False
+    return file_hash(src) == file_hash(dest)
+
+
+def atomic_copy(src, dest):
+    """Copy src over dest, so that dest is never left half written."""
+    tmp = dest.with_name(f'.{dest.name}.tmp')
+    shutil.copyfile(src, tmp)
+    if dest.exists():
+        shutil.copymode(dest, tmp)
+    os.replace(tmp, dest)
+
+
 def patch(patch_dir, viv_dir, **kwargs):
     assert patch_dir.exists(), "Invalid patch folder"
     assert viv_dir.exists(), "Invalid vivaldi installation folder"
 
-    appl_dir = find_appl_dir(viv_dir)
-    dest_dir = appl_dir / 'resources' / 'vivaldi'
-    assert dest_dir.exists(), "Invalid vivaldi installation folder"
-    print('Destination folder:', dest_dir)
-    PAIRS = (
-        (patch_dir / 'browser.html', dest_dir / 'browser.html'),
-        (patch_dir / 'custom.css', dest_dir / 'style' / 'custom.css'),
-        # (patch_dir / 'custom.js', dest_dir / 'style' / 'custom.js')
-    )
-    for src, dest in PAIRS:
-        if not src.exists():
-            print(src, "not found. Skipping.")
+    appl_dirs = find_appl_dirs(viv_dir)
+    if not appl_dirs:
+        print("Couldn't determine app folder!")
+        exit(1)
+    for appl_dir in appl_dirs:
+        dest_dir = appl_dir / 'resources' / 'vivaldi'
+        if not dest_dir.exists():
+            # stale or half installed version, eg: during a pending update
+            print(dest_dir, "not found. Skipping.")
             continue
-        with open(src) as s, open(dest, 'w') as d:
+        print('Destination folder:', dest_dir)
+        PAIRS = (
+            (patch_dir / 'browser.html', dest_dir / 'browser.html'),
+            (patch_dir / 'custom.css', dest_dir / 'style' / 'custom.css'),
+            # (patch_dir / 'custom.js', dest_dir / 'style' / 'custom.js')
+        )
+        for src, dest in PAIRS:
+            if not src.exists():
+                print(src, "not found. Skipping.")
+                continue
+            if same_contents(src, dest):
+                print(dest.name, 'is up to date')
+                continue
             print('Writing', dest.name)
-            d.write(s.read())
+            atomic_copy(src, dest)
 
 
-def print_changelog():
+CACHE_DIR = script_dir / '.cache'
+CHANGELOG_URL = "https://vivaldi.com/blog/snapshots/"
+
+
+def cached_get(session, url, cache_dir=CACHE_DIR):
+    """GET url, revalidating a copy cached on disk with ETag/Last-Modified."""
+    cache_file = cache_dir / (hashlib.sha256(url.encode()).hexdigest() + '.json')
+    try:
+        with open(cache_file, encoding='utf-8') as f:
+            cached = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        cached = None
+    headers = {}
+    if cached:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+    resp = session.get(url, headers=headers, timeout=10)
+    if resp.status_code == 304 and cached:
+        return cached['text']
+    resp.raise_for_status()
+    etag, last_modified = resp.headers.get('ETag'), resp.headers.get('Last-Modified')
+    if etag or last_modified:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_suffix('.tmp')
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({'etag': etag, 'last_modified': last_modified, 'text': resp.text}, f)
+        os.replace(tmp_file, cache_file)
+    return resp.text
+
+
+def html_parser():
+    try:
+        import lxml  # noqa: F401
+    except ImportError:
+        return "html.parser"
+    return "lxml"
+
+
+def fetch_changelog(base_url=CHANGELOG_URL, cache_dir=CACHE_DIR):
+    """Returns the text to print for the latest desktop snapshot changelog."""
     try:
         import requests
     except ImportError:
-        print("Need requests module to fetch changelog.")
-        return
+        return "Need requests module to fetch changelog."
     try:
         from bs4 import BeautifulSoup
     except ImportError:
-        print("Need bs4 module to fetch changelog.")
-        return
+        return "Need bs4 module to fetch changelog."
 
-    def get_changelog(url):
-        resp = requests.get(snap_url)
-        soup = BeautifulSoup(resp.text, "html5lib")
-        content = soup.find('div', {'class': "entry-content"})
-        return content.find_all('ul')[-1].text.strip()
-
-    BASE_URL = "https://vivaldi.com/blog/snapshots/"
-    resp = requests.get(BASE_URL)
-    soup = BeautifulSoup(resp.text, "html5lib")
-    for post in soup.select("header.article-header"):
-        title = post.h1.text
-        if "android" in title.lower():
-            continue
-        snap_url = post.a['href']
-        print("Snapshot URL:", snap_url)
-        print(title, post.p.text)
-        return print(get_changelog(snap_url))
-    print("Couldn't find proper snapshot to fetch changelog.")
+    parser = html_parser()
+    with requests.Session() as session:
+        def get_changelog(url):
+            soup = BeautifulSoup(cached_get(session, url, cache_dir), parser)
+            content = soup.find('div', {'class': "entry-content"})
+            return content.find_all('ul')[-1].text.strip()
+
+        try:
+            soup = BeautifulSoup(cached_get(session, base_url, cache_dir), parser)
+            for post in soup.select("header.article-header"):
+                title = post.h1.text
+                if "android" in title.lower():
+                    continue
+                snap_url = post.a['href']
+                return "\n".join((f"Snapshot URL: {snap_url}", f"{title} {post.p.text}",
+                                  get_changelog(snap_url)))
+        except requests.RequestException as e:
+            return f"Couldn't fetch changelog: {e}"
+    return "Couldn't find proper snapshot to fetch changelog."
+
+
+def print_changelog():
+    print(fetch_changelog())
 
 
 def get_all_sites(parent):
@@ -103,34 +193,125 @@ def get_all_sites(parent):
             yield from get_all_sites(child)
 
 
-def get_speeddial_items(bookmarks_file):
-    with open(bookmarks_file) as f:
-        bookmarks = json.load(f)
+def load_bookmarks(bookmarks_file):
+    with open(bookmarks_file, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def get_speeddial_items(bookmarks_file, bookmarks=None):
+    if bookmarks is None:
+        bookmarks = load_bookmarks(bookmarks_file)
     for child in bookmarks["roots"]["bookmark_bar"]["children"]:
         if child.get('meta_info', {}).get('Speeddial') == 'true':
             yield from get_all_sites(child)
 
 
-def get_thumbs(bookmarks_file, thumbs_dir: Path):
+def index_sites(bookmarks):
+    """Map bookmark id to its node, for every bookmark in the file."""
+    return {
+        site['id']: site
+        for root in bookmarks['roots'].values()
+        if isinstance(root, dict) and 'children' in root
+        for site in get_all_sites(root)
+    }
+
+
+def trigrams(word):
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class FuzzyMatcher:
+    """Usually the same result as difflib.get_close_matches(word, names, n=1, cutoff).
+
+    Only the max_candidates names with the best trigram overlap are scored, so
+    a match sharing no trigrams with word, or ranked below them, is missed."""
+
+    def __init__(self, names, cutoff=0.6, max_candidates=50):
+        self.names = list(names)
+        self.name_set = set(self.names)
+        self.cutoff = cutoff
+        self.max_candidates = max_candidates
+        self.index = defaultdict(list)
+        self.num_grams = []
+        for i, name in enumerate(self.names):
+            grams = trigrams(name)
+            self.num_grams.append(len(grams))
+            for gram in grams:
+                self.index[gram].append(i)
+
+    def match(self, word):
+        """Returns the closest name, or None if none is similar enough"""
+        if word in self.name_set:
+            return word
+        grams = trigrams(word)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.index.get(gram, ()))
+        # shortlist by trigram similarity (dice coefficient)
+        candidates = heapq.nlargest(
+            self.max_candidates, shared,
+            key=lambda i: shared[i] / (self.num_grams[i] + len(grams)))
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq2(word)
+        best = None
+        for i in candidates:
+            name = self.names[i]
+            matcher.set_seq1(name)
+            if (matcher.real_quick_ratio() >= self.cutoff
+                    and matcher.quick_ratio() >= self.cutoff):
+                score = matcher.ratio()
+                if score >= self.cutoff and (best is None or (score, name) > best):
+                    best = score, name
+        return best and best[1]
+
+
+def get_thumbs(bookmarks_file, thumbs_dir: Path, bookmarks=None):
     thumb_files = list(thumbs_dir.glob('*.[jp][pn]g'))
     thumbs = {thumb.stem.lower(): thumb for thumb in thumb_files}
-    for bookmark in get_speeddial_items(bookmarks_file):
-        m = difflib.get_close_matches(bookmark['name'].lower(), thumbs, n=1)
+    matcher = FuzzyMatcher(thumbs)
+    for bookmark in get_speeddial_items(bookmarks_file, bookmarks):
+        m = matcher.match(bookmark['name'].lower())
         if not m:
             print("Could not find thumbnail for", bookmark['name'])
             continue
-        yield bookmark['id'], thumbs[m[0]]
+        yield bookmark['id'], thumbs[m]
 
 
 def update_thumbs(bookmarks_file, thumbs_dir, **kwargs):
-    for bkmk, thumb_file in get_thumbs(bookmarks_file, thumbs_dir):
-        pass
+    """Point the speed dial thumbnails to the matching files in thumbs_dir.
+
+    The Bookmarks file is loaded and written once, atomically. Vivaldi should
+    be closed, or it will overwrite the changes."""
+    bookmarks = load_bookmarks(bookmarks_file)
+    sites = index_sites(bookmarks)
+    num_updated = 0
+    for bkmk, thumb_file in get_thumbs(bookmarks_file, thumbs_dir, bookmarks):
+        meta_info = sites[bkmk].setdefault('meta_info', {})
+        thumb_uri = thumb_file.resolve().as_uri()
+        if meta_info.get('Thumbnail') != thumb_uri:
+            meta_info['Thumbnail'] = thumb_uri
+            num_updated += 1
+    if not num_updated:
+        print("All thumbnails up to date.")
+        return
+    # the checksum covers the bookmark contents, it is recomputed when missing
+    bookmarks.pop('checksum', None)
+    bookmarks_file = Path(bookmarks_file)
+    tmp_file = bookmarks_file.with_name(bookmarks_file.name + '.tmp')
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(bookmarks, f, indent=3, ensure_ascii=False)
+    os.replace(tmp_file, bookmarks_file)
+    print("Updated", num_updated, "thumbnails")
 
 
 def main():
     cfg = load_config()
-    patch(**cfg['paths'])
-    print_changelog()
+    # fetch the changelog while patching, and print it once patching is done
+    with ThreadPoolExecutor(1) as pool:
+        changelog = pool.submit(fetch_changelog)
+        patch(**cfg['paths'])
+        print(changelog.result())
 
 
 if __name__ == '__main__':